@@ -0,0 +1,128 @@
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import make_test_pak
+import pakbackend
+
+from ps2_pak_dumper import PakDumper, bruteforce_filenames, find_packinfo
+
+# Bytes of entry data decrypted by the decrypt benchmark
+BENCH_DECRYPT_SIZE = 0x4000000
+
+
+def timed(func, *args):
+    # The dumper prints a line per file, which would mostly time the terminal
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        output = func(*args)
+
+    return output, time.perf_counter() - start
+
+
+def result(phase, seconds, size=None, count=None):
+    output = {'phase': phase, 'seconds': seconds}
+
+    if size is not None:
+        output['mb_per_sec'] = size / seconds / 0x100000 if seconds else None
+
+    if count is not None:
+        output['entries_per_sec'] = count / seconds if seconds else None
+
+    return output
+
+
+def decrypt_sample(dumper, limit=BENCH_DECRYPT_SIZE):
+    # Decrypting doesn't care whether an entry was stored encrypted, so any
+    # entries will do
+    buffers = []
+    entries = []
+    size = 0
+
+    for idx in dumper.extract_order:
+        entry = dumper.get_entry(idx)
+        packpath = dumper.get_pack_path(entry)
+
+        if packpath is None:
+            continue
+
+        buffers.append(bytearray(dumper.pack_pool.view(packpath, entry['offset'], entry['filesize'])))
+        entries.append(entry)
+        size += entry['filesize']
+
+        if size >= limit:
+            break
+
+    return buffers, entries, size
+
+
+def run_benchmark(input_path, output_path, args):
+    results = []
+
+    dumper, seconds = timed(PakDumper, find_packinfo(input_path), input_path, args.demux, args.decrypt_backend, args.jobs, args.verify, True, None, args.hash_backend)
+    results.append(result("index", seconds, os.path.getsize(find_packinfo(input_path)), len(dumper.entries)))
+
+    filenames, seconds = timed(bruteforce_filenames, dumper)
+    results.append(result("names", seconds, None, len(filenames)))
+
+    buffers, entries, size = decrypt_sample(dumper)
+    _, seconds = timed(dumper.decrypt_many, buffers, [entry['key1'] for entry in entries], [entry['key2'] for entry in entries])
+    results.append(result("decrypt", seconds, size, len(buffers)))
+
+    named, seconds = timed(dumper.extract_all, output_path)
+    results.append(result("extract", seconds, int(np.sum(dumper.entries['filesize'], dtype=np.int64)), len(dumper.entries)))
+
+    dumper.verifier.close()
+    dumper.pack_pool.close()
+
+    print("Using %s decryption and %s filename hashing" % (dumper.decrypt_backend, dumper.hash_backend))
+    print("%d entries, %d named" % (len(dumper.entries), named))
+
+    for x in results:
+        print("%-8s %9.3fs %12s %14s" % (
+            x['phase'],
+            x['seconds'],
+            "%.1f MB/s" % x['mb_per_sec'] if x.get('mb_per_sec') else "",
+            "%.1f entries/s" % x['entries_per_sec'] if x.get('entries_per_sec') else "",
+        ))
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', help='Input folder (a synthetic disc is generated if not given)', default=None)
+    parser.add_argument('-n', '--entries', help='Number of entries in the synthetic disc', default=1000, type=int)
+    parser.add_argument('-p', '--packs', help='Number of pack files in the synthetic disc', default=16, type=int)
+    parser.add_argument('-s', '--seed', help='Random seed for the synthetic disc', default=0, type=int)
+    parser.add_argument('-d', '--demux', help='Demux PSS files during extraction', default=False, action="store_true")
+    parser.add_argument('-j', '--jobs', help='Number of worker processes to use', default=1, type=int)
+    parser.add_argument('--decrypt-backend', help='Decryption implementation to use', default="auto", choices=["auto"] + [name for name, _ in pakbackend.DECRYPT_BACKENDS])
+    parser.add_argument('--hash-backend', help='Filename hashing implementation to use', default="auto", choices=["auto"] + [name for name, _ in pakbackend.HASH_BACKENDS])
+    parser.add_argument('--verify', help='Check the MD5 of every extracted file, a sample of them or none', default="full", choices=["none", "sample", "full"])
+    parser.add_argument('--json', help='Also write the results to this JSON file', default=None)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        input_path = args.input
+
+        if input_path is None:
+            input_path = os.path.join(temp_path, "input")
+            count, total_size, encrypted = make_test_pak.generate(input_path, args.entries, args.packs, args.seed)
+            print("Generated %d entries (%d encrypted), %d bytes" % (count, encrypted, total_size))
+
+        elif not find_packinfo(input_path):
+            print("Couldn't find packinfo.bin in input directory")
+            exit(1)
+
+        results = run_benchmark(input_path, os.path.join(temp_path, "output"), args)
+
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump(results, outfile, indent=4)
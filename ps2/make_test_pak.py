@@ -0,0 +1,147 @@
+import argparse
+import hashlib
+import os
+
+import numpy as np
+
+import pakcrypt
+import pakhash
+
+from ps2_pak_dumper import PACK_ENTRY_DTYPE
+
+# Real filename templates the bruteforcer knows about, so generated discs
+# exercise name resolution the same way a real one does
+NAME_TEMPLATES = [
+    "/data/product/music/m%04d/d%04d.sq3",
+    "/data/product/music/m%04d/g%04d.sq3",
+    "/data/product/music/m%04d/spu%04dd.va3",
+    "/data/product/music/m%04d/spu%04dg.va3",
+    "/data/product/music/m%04d/bgm%04d.pss",
+    "/data/product/music/m%04d/event%04d.evt",
+    "/data/product/music/m%04d/fre%04d.bin",
+    "/data/product/music/m%04d/i%04ddm.bin",
+    "/data/product/music/m%04d/i%04dgf.bin",
+]
+
+# Video payload per packet in generated PSS files
+PSS_PACKET_SIZE = 0x800
+
+
+def make_pss(rng, size):
+    # A minimal MPEG program stream that pss_demux can take apart
+    data = bytearray(b"\x00\x00\x01\xba" + bytes(10))
+
+    while len(data) < size:
+        payload = rng.bytes(PSS_PACKET_SIZE)
+        data += b"\x00\x00\x01\xe0" + (len(payload) + 3).to_bytes(2, byteorder="big") + b"\x00\x00\x00" + payload
+
+    data += b"\x00\x00\x01\xb9"
+
+    return bytes(data)
+
+
+def make_names(rng, count, unnamed_ratio):
+    names = {}
+    key1s = set()
+
+    while len(names) < count:
+        if rng.random() < unnamed_ratio:
+            name = "/data/product/unknown/%08x.bin" % rng.integers(0, 1 << 32)
+
+        else:
+            song_id = int(rng.integers(0, 9999))
+            name = NAME_TEMPLATES[rng.integers(0, len(NAME_TEMPLATES))] % (song_id, song_id)
+
+        if name in names:
+            continue
+
+        crc32, crc16, crc16_cs = [int(x[0]) for x in pakhash.hash_many([name])]
+
+        # Real discs never have two entries with the same key1
+        if crc32 in key1s:
+            continue
+
+        key1s.add(crc32)
+        names[name] = (crc32, crc16 if rng.random() < 0.5 else crc16_cs)
+
+    return names
+
+
+def generate(output, entries=1000, packs=16, seed=0, encrypted_ratio=0.5, unnamed_ratio=0.1, min_size=4, max_size=0x100000):
+    # Writes data/pack/packinfo.bin and the packs it points at under output.
+    # Returns the number of entries, bytes of entry data and encrypted entries
+    rng = np.random.default_rng(seed)
+    names = list(make_names(rng, entries, unnamed_ratio).items())
+    packids = np.sort(rng.choice(3000, size=min(packs, 3000), replace=False))
+
+    records = np.zeros(len(names), dtype=PACK_ENTRY_DTYPE)
+    records['packid'] = rng.choice(packids, size=len(names))
+
+    # Log-uniform sizes give mostly small files with a few large ones
+    sizes = np.exp(rng.uniform(np.log(min_size), np.log(max_size), size=len(names))).astype(np.int64)
+
+    total_size = 0
+    encrypted = 0
+
+    for packid in packids:
+        idxs = np.nonzero(records['packid'] == packid)[0]
+
+        if not len(idxs):
+            continue
+
+        pack_folder = "pack_v3" if rng.random() < 0.1 else "pack"
+        packpath = os.path.join(output, "data", pack_folder, "d%03d" % (packid // 30), "pack%04d.pak" % packid)
+        os.makedirs(os.path.dirname(packpath), exist_ok=True)
+
+        with open(packpath, "wb") as outfile:
+            for idx in idxs:
+                name, (key1, key2) = names[idx]
+
+                if name.endswith(".pss"):
+                    data = bytearray(make_pss(rng, sizes[idx]))
+
+                else:
+                    data = bytearray(rng.bytes(int(sizes[idx])))
+
+                record = records[idx]
+                record['md5sum'] = hashlib.md5(data).digest()
+                record['key1'] = key1
+                record['key2'] = key2
+                record['offset'] = outfile.tell()
+                record['filesize'] = len(data)
+
+                # The cipher is a plain XOR keystream, so decrypting encrypts
+                if rng.random() < encrypted_ratio:
+                    pakcrypt.decrypt(data, key1, key2)
+                    encrypted += 1
+
+                outfile.write(data)
+                outfile.write(bytes(int(rng.integers(0, 0x40))))
+                total_size += len(data)
+
+    packinfo_path = os.path.join(output, "data", "pack", "packinfo.bin")
+    os.makedirs(os.path.dirname(packinfo_path), exist_ok=True)
+
+    with open(packinfo_path, "wb") as outfile:
+        outfile.write(bytes(8) + (0x10 + records.nbytes).to_bytes(4, 'little') + bytes(4))
+        outfile.write(records.tobytes())
+
+    return len(records), total_size, encrypted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='Output folder for the synthetic disc', required=True)
+    parser.add_argument('-n', '--entries', help='Number of entries', default=1000, type=int)
+    parser.add_argument('-p', '--packs', help='Number of pack files', default=16, type=int)
+    parser.add_argument('-s', '--seed', help='Random seed', default=0, type=int)
+    parser.add_argument('--encrypted', help='Fraction of entries stored encrypted', default=0.5, type=float)
+    parser.add_argument('--unnamed', help='Fraction of entries with names the bruteforcer will not find', default=0.1, type=float)
+    parser.add_argument('--min-size', help='Smallest entry size in bytes', default=4, type=int)
+    parser.add_argument('--max-size', help='Largest entry size in bytes', default=0x100000, type=int)
+
+    args = parser.parse_args()
+
+    count, total_size, encrypted = generate(args.output, args.entries, args.packs, args.seed, args.encrypted, args.unnamed, args.min_size, args.max_size)
+
+    print("Wrote %d entries (%d encrypted), %d bytes" % (count, encrypted, total_size))
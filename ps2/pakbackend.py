@@ -0,0 +1,162 @@
+import importlib
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import pakcrypt
+import pakhash
+
+
+# Threads decrypting a batch with the compiled decryptor, which drops the GIL
+DECRYPT_WORKERS = os.cpu_count() or 1
+
+# Entries smaller than this are decrypted on the calling thread, handing them
+# to the pool costs more than decrypting them
+DECRYPT_THREAD_MIN_SIZE = 0x10000
+
+# Size of the sample each backend is timed on with --calibrate
+CALIBRATION_ENTRIES = 16
+CALIBRATION_SIZE = 0x4000
+CALIBRATION_NAMES = 0x800
+
+# Pool of the compiled decryptor and the process it was started in, a forked
+# child gets the pool object but none of its threads
+decrypt_pool = None
+decrypt_pool_pid = None
+
+
+def get_decrypt_pool():
+    global decrypt_pool, decrypt_pool_pid
+
+    if decrypt_pool is None or decrypt_pool_pid != os.getpid():
+        decrypt_pool = ThreadPoolExecutor(DECRYPT_WORKERS)
+        decrypt_pool_pid = os.getpid()
+
+    return decrypt_pool
+
+
+def decrypt_many_compiled(buffers, key1s, key2s):
+    import pakdec
+
+    buffers = list(buffers)
+    key1s = list(key1s)
+    key2s = list(key2s)
+    large = [i for i, data in enumerate(buffers) if len(data) >= DECRYPT_THREAD_MIN_SIZE]
+    futures = []
+
+    if len(large) > 1 and DECRYPT_WORKERS > 1:
+        pool = get_decrypt_pool()
+        futures = [pool.submit(pakdec.decrypt, buffers[i], len(buffers[i]), key1s[i], key2s[i]) for i in large]
+        large = set(large)
+
+    else:
+        large = set()
+
+    for i, (data, key1, key2) in enumerate(zip(buffers, key1s, key2s)):
+        if i not in large:
+            pakdec.decrypt(data, len(data), key1, key2)
+
+    for future in futures:
+        future.result()
+
+    return buffers
+
+
+def decrypt_many_python(buffers, key1s, key2s):
+    buffers = list(buffers)
+
+    for data, key1, key2 in zip(buffers, key1s, key2s):
+        pakcrypt.decrypt_python(data, key1, key2)
+
+    return buffers
+
+
+def hash_crc32_python(candidates):
+    crc = pakhash.CRC32
+    return np.array([crc.update(crc.seed, pakhash.normalize_filename(x).encode('ascii')) ^ crc.xorout for x in candidates], dtype=np.uint32)
+
+
+def hash_crc16_python(candidates):
+    candidates = [x.encode('ascii') for x in candidates]
+    crc16 = np.array([pakhash.CRC16.update(pakhash.CRC16.seed, x) ^ pakhash.CRC16.xorout for x in candidates], dtype=np.uint16)
+    crc16_cs = np.array([pakhash.CRC16_CS.update(pakhash.CRC16_CS.seed, x) ^ pakhash.CRC16_CS.xorout for x in candidates], dtype=np.uint16)
+    return crc16, crc16_cs
+
+
+def load_compiled_decrypt():
+    # Raises ImportError when pakdec.pyx hasn't been built
+    importlib.import_module("pakdec")
+    return decrypt_many_compiled
+
+
+# Backends in order of preference, each with a loader that returns the
+# implementation or raises ImportError when it can't be used here
+DECRYPT_BACKENDS = [
+    ("compiled", load_compiled_decrypt),
+    ("numpy", lambda: pakcrypt.decrypt_many),
+    ("python", lambda: decrypt_many_python),
+]
+
+HASH_BACKENDS = [
+    ("numpy", lambda: (pakhash.hash_crc32_many, pakhash.hash_crc16_many)),
+    ("python", lambda: (hash_crc32_python, hash_crc16_python)),
+]
+
+
+def available_backends(backends):
+    output = []
+
+    for name, loader in backends:
+        try:
+            output.append((name, loader()))
+
+        except ImportError:
+            pass
+
+    return output
+
+
+def time_decrypt(decrypt_many):
+    buffers = [bytearray(CALIBRATION_SIZE) for _ in range(CALIBRATION_ENTRIES)]
+    start = time.perf_counter()
+    decrypt_many(buffers, range(CALIBRATION_ENTRIES), range(CALIBRATION_ENTRIES))
+    return time.perf_counter() - start
+
+
+def time_hash(hashes):
+    crc32_many, crc16_many = hashes
+    names = ["/data/product/music/m%04d/bgm%04d.pss" % (i, i) for i in range(CALIBRATION_NAMES)]
+    start = time.perf_counter()
+    crc32_many(names)
+    crc16_many(names)
+    return time.perf_counter() - start
+
+
+def select_backend(backends, name="auto", timer=None):
+    # Returns (name, implementation). An explicitly requested backend that
+    # isn't available falls back to automatic selection. Without a timer the
+    # first available backend is used, otherwise the fastest on a sample
+    candidates = available_backends(backends)
+
+    if name != "auto":
+        for candidate in candidates:
+            if candidate[0] == name:
+                return candidate
+
+        print("The %s backend isn't available, picking one automatically" % name)
+
+    if timer is not None and len(candidates) > 1:
+        return min(candidates, key=lambda candidate: timer(candidate[1]))
+
+    return candidates[0]
+
+
+def select_decrypt(name="auto", calibrate=False):
+    return select_backend(DECRYPT_BACKENDS, name, time_decrypt if calibrate else None)
+
+
+def select_hash(name="auto", calibrate=False):
+    return select_backend(HASH_BACKENDS, name, time_hash if calibrate else None)
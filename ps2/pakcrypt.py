@@ -0,0 +1,165 @@
+import numpy as np
+
+
+# Number of keystream words generated per lane before they are XORed in
+BLOCK_WORDS = 0x4000
+
+# Below this many lanes, stepping each keystream with plain ints is faster
+# than stepping all of them as a NumPy vector
+MIN_VECTOR_LANES = 8
+
+
+def keystream(key, key2, count):
+    # Returns the next count keys and the key to continue from
+    output = [0] * count
+
+    for i in range(count):
+        key = (key + key2) & 0xFFFFFFFF
+        key = ((key << 3) & 0xFFFFFFFF) | (key >> 29)
+        output[i] = key
+
+    return np.array(output, dtype=np.uint32), key
+
+
+def keystream_lanes(keys, key2s, count):
+    output = np.empty((len(keys), count), dtype=np.uint32)
+
+    for i in range(count):
+        keys = keys + key2s
+        keys = (keys << 3) | (keys >> 29)
+        output[:, i] = keys
+
+    return output, keys
+
+
+def decrypt_python(data, key1, key2):
+    # Reference implementation, one word at a time
+    key = key1
+    aligned = len(data) // 4 * 4
+
+    for i in range(0, aligned, 4):
+        key = (key + key2) & 0xFFFFFFFF
+        key = ((key << 3) & 0xFFFFFFFF) | (key >> 29)
+
+        data[i] ^= key & 0xff
+        data[i + 1] ^= (key >> 8) & 0xff
+        data[i + 2] ^= (key >> 16) & 0xff
+        data[i + 3] ^= (key >> 24) & 0xff
+
+    key = (key + key2) & 0xFFFFFFFF
+    key = ((key << 3) & 0xFFFFFFFF) | (key >> 29)
+    xor_tail(data, aligned, key)
+
+    return data
+
+
+def xor_tail(data, offset, key):
+    # The last partial word XORs every key byte it covers into the first
+    # byte of that word, which is what the original decryptor does
+    for j in range(len(data) - offset):
+        data[offset] ^= (key >> (j * 8)) & 0xff
+
+
+def decrypt_many(buffers, key1s, key2s):
+    # Decrypts many writable buffers in place. The keystream of one entry is
+    # a sequential recurrence, but entries are independent of each other, so
+    # every entry gets a uint32 lane and all lanes are stepped together.
+    buffers = list(buffers)
+
+    if not buffers:
+        return buffers
+
+    # Every lane needs one key per whole word plus one for the tail
+    steps = np.array([len(x) // 4 + 1 for x in buffers], dtype=np.int64)
+    order = np.argsort(-steps, kind='stable')
+    steps = steps[order]
+
+    keys = np.array(key1s, dtype=np.uint32)[order]
+    key2s = np.array(key2s, dtype=np.uint32)[order]
+    words = [np.frombuffer(buffers[idx], dtype='<u4', count=len(buffers[idx]) // 4) for idx in order]
+
+    for start in range(0, int(steps[0]), BLOCK_WORDS):
+        # Lanes are sorted longest first, so the active ones are a prefix
+        active = int(np.count_nonzero(steps > start))
+        count = min(BLOCK_WORDS, int(steps[0]) - start)
+
+        if active >= MIN_VECTOR_LANES:
+            stream, keys[:active] = keystream_lanes(keys[:active], key2s[:active], count)
+
+        else:
+            stream = []
+
+            for lane in range(active):
+                lane_stream, keys[lane] = keystream(int(keys[lane]), int(key2s[lane]), min(count, int(steps[lane]) - start))
+                stream.append(lane_stream)
+
+        for lane in range(active):
+            lane_words = words[lane][start:start+count]
+            lane_words ^= stream[lane][:len(lane_words)]
+
+            if start + count >= steps[lane]:
+                # The key after the last whole word belongs to the tail
+                buffer = buffers[order[lane]]
+                xor_tail(buffer, len(buffer) // 4 * 4, int(stream[lane][steps[lane] - 1 - start]))
+
+    return buffers
+
+
+def decrypt(data, key1, key2):
+    return decrypt_many([data], [key1], [key2])[0]
+
+
+# Words between the keys a Keystream remembers, seeking replays at most this
+CHECKPOINT_WORDS = 0x4000
+
+
+class Keystream:
+    # The keystream of a single entry, positioned by word index. The key in
+    # front of every CHECKPOINT_WORDS-th word is kept, so jumping around in
+    # an entry never replays the recurrence from the start again
+    def __init__(self, key1, key2, checkpoint_words=CHECKPOINT_WORDS):
+        self.key2 = key2
+        self.checkpoint_words = checkpoint_words
+        self.checkpoints = [key1]
+
+
+    def key_at(self, word):
+        # Key in front of the given word
+        checkpoint = word // self.checkpoint_words
+
+        while len(self.checkpoints) <= checkpoint:
+            _, key = keystream(self.checkpoints[-1], self.key2, self.checkpoint_words)
+            self.checkpoints.append(key)
+
+        key = self.checkpoints[checkpoint]
+
+        if word % self.checkpoint_words:
+            _, key = keystream(key, self.key2, word % self.checkpoint_words)
+
+        return key
+
+
+    def words(self, first, count):
+        stream, key = keystream(self.key_at(first), self.key2, count)
+
+        if first % self.checkpoint_words == 0 and count == self.checkpoint_words and len(self.checkpoints) == first // self.checkpoint_words + 1:
+            self.checkpoints.append(key)
+
+        return stream
+
+
+    def decrypt(self, data, start, total):
+        # Decrypts in place the part of an entry of total bytes that starts
+        # at byte start (a multiple of 4), handling the entry's tail if the
+        # part reaches it
+        aligned = total // 4 * 4
+        count = (min(start + len(data), aligned) - start) // 4
+
+        if count > 0:
+            words = np.frombuffer(data, dtype='<u4', count=count)
+            words ^= self.words(start // 4, count)
+
+        if total % 4 and start <= aligned < start + len(data):
+            xor_tail(data, aligned - start, int(self.words(aligned // 4, 1)[0]))
+
+        return data
@@ -1,24 +1,39 @@
-# cython: cdivision=True
+# cython: cdivision=True, boundscheck=False, wraparound=False
 
-cdef rol(int val, int r_bits):
-    return (val << r_bits) & 0xFFFFFFFF | ((val & 0xFFFFFFFF) >> (32 - r_bits))
+cdef inline unsigned int rol(unsigned int val, int r_bits) nogil:
+    return (val << r_bits) | (val >> (32 - r_bits))
 
-cpdef decrypt(unsigned char *data, size_t data_len, unsigned int key1, unsigned short key2):
+cpdef decrypt(unsigned char[::1] data, size_t data_len, unsigned int key1, unsigned short key2):
+    # data can be any writable buffer (bytearray, memoryview, NumPy array).
+    # The GIL is released while decrypting so threads can run in parallel
     cdef unsigned int key = key1
     cdef size_t i = 0
+    cdef size_t j
+    cdef unsigned char *ptr
 
-    while i < (data_len // 4) * 4:
-        key = rol(key + key2, 3)
+    if data_len > <size_t>data.shape[0]:
+        data_len = data.shape[0]
+
+    if data_len == 0:
+        return data
+
+    ptr = &data[0]
 
-        data[i] ^= key & 0xff
-        data[i + 1] ^= (key >> 8) & 0xff
-        data[i + 2] ^= (key >> 16) & 0xff
-        data[i + 3] ^= (key >> 24) & 0xff
+    with nogil:
+        while i < (data_len // 4) * 4:
+            key = rol(key + key2, 3)
 
-        i += 4
+            ptr[i] ^= key & 0xff
+            ptr[i + 1] ^= (key >> 8) & 0xff
+            ptr[i + 2] ^= (key >> 16) & 0xff
+            ptr[i + 3] ^= (key >> 24) & 0xff
 
-    key = rol(key + key2, 3)
-    key_parts = [key & 0xff, (key >> 8) & 0xff, (key >> 16) & 0xff, (key >> 24) & 0xff]
-    for j in range(data_len - i):
-            data[i] ^= key_parts[j]
+            i += 4
+
+        # Every key byte covered by the partial last word goes into its
+        # first byte, same as the original decryptor
+        key = rol(key + key2, 3)
+        for j in range(data_len - i):
+            ptr[i] ^= (key >> (j * 8)) & 0xff
 
+    return data
@@ -0,0 +1,415 @@
+import re
+
+import numpy as np
+
+
+BATCH_SIZE = 0x10000
+
+
+def generate_table(poly, width, reflected):
+    table = []
+    top_bit = 1 << (width - 1)
+    mask = (1 << width) - 1
+
+    for i in range(0, 256):
+        if reflected:
+            crc = i
+            for j in range(0, 8):
+                crc = (crc >> 1) ^ poly if crc & 1 else crc >> 1
+
+        else:
+            crc = i << (width - 8)
+            for j in range(0, 8):
+                crc = ((crc << 1) ^ poly if crc & top_bit else crc << 1) & mask
+
+        table.append(crc)
+
+    return table
+
+
+class Crc:
+    # Works on the raw CRC register so that states can be saved after a
+    # prefix and carried on later; finish() applies the final xor
+    def __init__(self, poly, width, reflected, seed, xorout):
+        self.width = width
+        self.mask = (1 << width) - 1
+        self.reflected = reflected
+        self.seed = seed
+        self.xorout = xorout
+        self.dtype = np.uint32 if width == 32 else np.uint16
+        self.table_list = generate_table(poly, width, reflected)
+        self.table = np.array(self.table_list, dtype=self.dtype)
+        self.jumps = {}
+
+        self.reverse = np.zeros(256, dtype=np.int64)
+        self.reverse[self.table >> (width - 8)] = np.arange(256)
+
+
+    def update(self, state, data):
+        table = self.table_list
+
+        if self.reflected:
+            for b in data:
+                state = table[(state ^ b) & 0xff] ^ (state >> 8)
+
+        else:
+            shift = self.width - 8
+            for b in data:
+                state = table[((state >> shift) ^ b) & 0xff] ^ ((state << 8) & self.mask)
+
+        return state
+
+
+    def update_column(self, state, col):
+        if self.reflected:
+            return self.table[(state ^ col) & 0xff] ^ (state >> 8)
+
+        return self.table[((state >> (self.width - 8)) ^ col) & 0xff] ^ (state << 8)
+
+
+    def update_columns(self, state, matrix, lengths=None):
+        # matrix holds one left-aligned string per row, rows shorter than the
+        # matrix width stop updating once their own length is reached
+        for idx, col in enumerate(matrix.T):
+            if lengths is None:
+                state = self.update_column(state, col)
+
+            else:
+                state = np.where(lengths > idx, self.update_column(state, col), state)
+
+        return state
+
+
+    def jump(self, data):
+        # CRC registers are linear, so running a fixed piece of data through
+        # any state is crc(state, zeros) ^ crc(0, data). The zeros part is
+        # tabulated per state byte, giving width/8 lookups for any length.
+        if len(data) not in self.jumps:
+            tables = []
+
+            for shift in range(0, self.width, 8):
+                tables.append(np.array([self.update(v << shift, bytes(len(data))) for v in range(256)], dtype=self.dtype))
+
+            self.jumps[len(data)] = tables
+
+        return self.jumps[len(data)], self.update(0, data)
+
+
+    def extend(self, state, data):
+        if len(data) <= self.width // 8:
+            for b in data:
+                state = self.update_column(state, b)
+
+            return state
+
+        tables, constant = self.jump(data)
+        output = np.full(len(state), constant, dtype=self.dtype)
+
+        for idx, table in enumerate(tables):
+            output ^= table[(state >> (idx * 8)) & 0xff]
+
+        return output
+
+
+    def seed_fixups(self, lengths):
+        # crc(seed, msg) == crc(0, msg) ^ crc(seed, zeros(len(msg))), which
+        # lets right-aligned zero-padded batches start from a zero register
+        fixups = np.zeros(int(lengths.max()) + 1 if len(lengths) else 1, dtype=self.dtype)
+        state = self.seed
+
+        for i in range(len(fixups)):
+            fixups[i] = state
+            state = self.update(state, b"\0")
+
+        return fixups[lengths]
+
+
+    def finish(self, state):
+        return state ^ self.dtype(self.xorout)
+
+
+    def rewind_column(self, state, col):
+        # Steps a reflected CRC register back over one byte. Every table entry
+        # has a distinct top byte, which identifies the table index that was
+        # mixed in on the way forward.
+        if not self.reflected:
+            raise NotImplementedError("Only reflected CRCs can be rewound")
+
+        idx = self.reverse[state >> (self.width - 8)]
+        return (((state ^ self.table[idx]) << 8) | (idx ^ col)).astype(self.dtype)
+
+
+    def rewind(self, state, data):
+        for b in reversed(data):
+            state = self.rewind_column(state, b)
+
+        return state
+
+
+# Filename CRC32 (standard reflected polynomial) and the two CRC16 variants
+# the pack index stores in key2
+CRC32 = Crc(0xEDB88320, 32, True, 0xffffffff, 0xffffffff)
+CRC16 = Crc(0x8408, 16, True, 0xffff, 0xffff)
+CRC16_CS = Crc(0x1021, 16, False, 0, 0)
+
+
+def normalize_filename(input):
+    if input.startswith("data/"):
+        input = "/" + input
+
+    if input.startswith("/data/aep"):
+        input = input.lower()
+
+    return input
+
+
+def pack_strings(strings, right_align=True):
+    encoded = [s.encode('ascii') for s in strings]
+    lengths = np.fromiter((len(s) for s in encoded), dtype=np.int64, count=len(encoded))
+    width = int(lengths.max()) if len(encoded) else 0
+
+    if right_align:
+        matrix = b"".join(s.rjust(width, b"\0") for s in encoded)
+
+    else:
+        matrix = b"".join(s.ljust(width, b"\0") for s in encoded)
+
+    return np.frombuffer(matrix, dtype=np.uint8).reshape(len(encoded), width), lengths
+
+
+def hash_columns(crc, matrix, lengths):
+    # Leading zero bytes don't change a CRC register that is still zero, so
+    # right-aligned rows can all be fed column by column without masking
+    state = crc.update_columns(np.zeros(len(matrix), dtype=crc.dtype), matrix)
+    return crc.finish(state ^ crc.seed_fixups(lengths))
+
+
+def hash_crc32_many(candidates):
+    # Matches calculate_filename_hash
+    candidates = list(candidates)
+    crc32 = np.zeros(len(candidates), dtype=np.uint32)
+
+    for start in range(0, len(candidates), BATCH_SIZE):
+        batch = [normalize_filename(x) for x in candidates[start:start+BATCH_SIZE]]
+        crc32[start:start+len(batch)] = hash_columns(CRC32, *pack_strings(batch))
+
+    return crc32
+
+
+def hash_crc16_many(candidates):
+    # Matches calculate_filename_hash_crc16 and calculate_filename_hash_crc16_cs
+    candidates = list(candidates)
+    crc16 = np.zeros(len(candidates), dtype=np.uint16)
+    crc16_cs = np.zeros(len(candidates), dtype=np.uint16)
+
+    for start in range(0, len(candidates), BATCH_SIZE):
+        batch = candidates[start:start+BATCH_SIZE]
+        matrix, lengths = pack_strings(batch)
+        crc16[start:start+len(batch)] = hash_columns(CRC16, matrix, lengths)
+        crc16_cs[start:start+len(batch)] = hash_columns(CRC16_CS, matrix, lengths)
+
+    return crc16, crc16_cs
+
+
+def hash_many(candidates):
+    # Returns (crc32, crc16, crc16_cs) arrays matching calculate_filename_hash,
+    # calculate_filename_hash_crc16 and calculate_filename_hash_crc16_cs
+    candidates = list(candidates)
+    return (hash_crc32_many(candidates),) + hash_crc16_many(candidates)
+
+
+def rows_to_columns(rows):
+    # Field values are shipped around as one NumPy array per field, which
+    # is far cheaper to slice and pickle than lists of tuples
+    return [np.array(values) for values in zip(*rows)]
+
+
+class Template:
+    # A filename template such as "/data/product/music/m%04d/bgm%04d.pss".
+    # The fixed text before the first field is hashed once, fields are hashed
+    # column-wise over all rows and the fixed text between and after fields
+    # is combined in with CRC jump tables, so the cost of a candidate only
+    # depends on the length of its variable parts.
+    FIELD = re.compile(r"%(0?\d*)([ds])")
+
+    def __init__(self, template):
+        self.template = template
+        self.lowercase = normalize_filename(template).startswith("/data/aep")
+        self.pieces = self.FIELD.split(template)[0::3]
+        self.fields = ["%" + "".join(x) for x in self.FIELD.findall(template)]
+
+        normalized_pieces = self.FIELD.split(normalize_filename(template))[0::3]
+
+        self.prefixes = [
+            (CRC32, CRC32.update(CRC32.seed, normalized_pieces[0].encode('ascii')), normalized_pieces[1:]),
+            (CRC16, CRC16.update(CRC16.seed, self.pieces[0].encode('ascii')), self.pieces[1:]),
+            (CRC16_CS, CRC16_CS.update(CRC16_CS.seed, self.pieces[0].encode('ascii')), self.pieces[1:]),
+        ]
+
+
+    def format_field(self, field, values):
+        if field[-1] == 'd':
+            numbers = np.array(values)
+
+            if numbers.dtype.kind in 'iu' and numbers.min() >= 0:
+                digits = len(field % numbers.max())
+
+                if len(field % numbers.min()) == digits:
+                    # Every number formats to the same width, so the digit
+                    # columns can be built directly
+                    columns = [(numbers // 10 ** (digits - idx - 1)) % 10 + 0x30 for idx in range(digits)]
+                    return np.stack(columns, axis=1).astype(np.uint8), None
+
+        return pack_strings([field % v for v in values], right_align=False)
+
+
+    def hash_columns(self, columns, count, prefixes=None):
+        # prefixes picks which of the CRCs to compute, all three by default
+        prefixes = self.prefixes if prefixes is None else prefixes
+
+        if not count:
+            return tuple(np.zeros(0, dtype=crc.dtype) for crc, _, _ in prefixes)
+
+        fields = [self.format_field(field, values) for field, values in zip(self.fields, columns)]
+        output = []
+
+        for crc, prefix_state, pieces in prefixes:
+            state = np.full(count, prefix_state, dtype=crc.dtype)
+
+            for idx, (matrix, lengths) in enumerate(fields):
+                if crc is CRC32 and self.lowercase:
+                    matrix = np.where((matrix >= 0x41) & (matrix <= 0x5a), matrix + 0x20, matrix).astype(np.uint8)
+
+                state = crc.update_columns(state, matrix, lengths)
+                state = crc.extend(state, pieces[idx].encode('ascii'))
+
+            output.append(crc.finish(state))
+
+        return tuple(output)
+
+
+    def format(self, row):
+        return self.template % tuple(row)
+
+
+    def format_columns(self, columns, idx):
+        return self.format(column[idx] for column in columns)
+
+
+def enumerate_strings(charset, length):
+    # All strings of the given length over charset, one per row
+    charset = np.frombuffer(charset.encode('ascii'), dtype=np.uint8)
+    combos = np.arange(len(charset) ** length, dtype=np.int64)
+    columns = [charset[(combos // len(charset) ** (length - idx - 1)) % len(charset)] for idx in range(length)]
+
+    if not columns:
+        return np.zeros((1, 0), dtype=np.uint8)
+
+    return np.stack(columns, axis=1)
+
+
+def solve_crc32(prefix, suffix, targets, charset, length, max_table=1 << 24, max_block=1 << 22):
+    # Finds every middle of the given length over charset such that
+    # prefix + middle + suffix hashes to one of the target CRC32s. Meet in
+    # the middle: states after prefix + left half are tabulated once, then
+    # each target is rewound through the suffix and every right half and
+    # looked up in that table. Yields (target, middle) pairs.
+    prefix = normalize_filename(prefix)
+
+    if prefix.startswith("/data/aep"):
+        suffix = suffix.lower()
+        charset = "".join(sorted(set(charset.lower())))
+
+    targets = np.array(sorted(set(targets)), dtype=np.uint32)
+
+    if len(targets) == 0 or len(charset) == 0:
+        return
+
+    # Pick the split that keeps the table in memory and balances building
+    # it against probing it once per target
+    splits = [k for k in range(0, length + 1) if len(charset) ** (length - k) <= max_table]
+    if not splits:
+        raise ValueError("Middle length %d is too long for a charset of %d characters" % (length, len(charset)))
+
+    right_length = min(splits, key=lambda k: len(charset) ** (length - k) + len(targets) * len(charset) ** k)
+
+    left = enumerate_strings(charset, length - right_length)
+    left_states = CRC32.update_columns(np.full(len(left), CRC32.update(CRC32.seed, prefix.encode('ascii')), dtype=np.uint32), left)
+    order = np.argsort(left_states, kind='stable')
+    left_states = left_states[order]
+
+    right = enumerate_strings(charset, right_length)
+    middle_states = CRC32.rewind(CRC32.finish(targets), suffix.encode('ascii'))
+
+    # Rewind as many targets at once as fit into one block
+    chunk = max(1, max_block // len(right))
+
+    for start in range(0, len(targets), chunk):
+        states = np.repeat(middle_states[start:start+chunk, None], len(right), axis=1)
+
+        for col in reversed(range(right_length)):
+            states = CRC32.rewind_column(states, right[:, col])
+
+        lo = np.searchsorted(left_states, states, side='left')
+        hi = np.searchsorted(left_states, states, side='right')
+
+        for target_idx, right_idx in zip(*np.nonzero(hi > lo)):
+            for left_idx in order[lo[target_idx, right_idx]:hi[target_idx, right_idx]]:
+                middle = (left[left_idx].tobytes() + right[right_idx].tobytes()).decode('ascii')
+                yield int(targets[start + target_idx]), middle
+
+
+def find_keys(key1s, crc32):
+    # key1s is sorted. Returns the indexes of the candidates whose CRC32 is a
+    # key1 along with the position of that key
+    if len(key1s) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    pos = np.minimum(np.searchsorted(key1s, crc32), len(key1s) - 1)
+    found = key1s[pos] == crc32
+
+    return np.nonzero(found)[0], pos[found]
+
+
+def match_filenames(key1s, key2s, candidates, crc32_many=hash_crc32_many, crc16_many=hash_crc16_many):
+    # key1s is sorted with key2s in the same order. Returns the indexes of
+    # candidates whose CRC32 is a key1 and either CRC16 matches its key2,
+    # along with the position of the matching key. Almost every candidate
+    # misses on the CRC32, so the CRC16s are only computed for the few that
+    # hit
+    candidates = list(candidates)
+    idxs, pos = find_keys(key1s, crc32_many(candidates))
+
+    crc16, crc16_cs = crc16_many([candidates[idx] for idx in idxs])
+    found = (key2s[pos] == crc16) | (key2s[pos] == crc16_cs)
+
+    return idxs[found], pos[found]
+
+
+def find_template_matches(template, columns, count, key1s, key2s):
+    template = Template(template)
+    crc32, = template.hash_columns(columns, count, template.prefixes[:1])
+    idxs, pos = find_keys(key1s, crc32)
+
+    if not len(idxs):
+        return []
+
+    columns = [column[idxs] for column in columns]
+    crc16, crc16_cs = template.hash_columns(columns, len(idxs), template.prefixes[1:])
+    found = (key2s[pos] == crc16) | (key2s[pos] == crc16_cs)
+
+    return [(template.format_columns(columns, idx), int(p)) for idx, p in zip(np.nonzero(found)[0], pos[found])]
+
+
+# Worker processes get their own copy of the key arrays once at startup
+# so that only templates, rows and hits travel between processes
+worker_keys = None
+
+
+def init_template_worker(key1s, key2s):
+    global worker_keys
+    worker_keys = (key1s, key2s)
+
+
+def template_worker(template, columns, count):
+    return find_template_matches(template, columns, count, *worker_keys)
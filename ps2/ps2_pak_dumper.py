@@ -1,19 +1,738 @@
 import argparse
+import contextlib
+import cProfile
 import glob
 import hashlib
+import io
 import itertools
+import json
+import mmap
 import os
-import struct
-
+import pstats
+import shutil
+import sqlite3
+import threading
+import time
+import tracemalloc
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from ctypes import c_ulong
 
+import numpy as np
+
+import pakbackend
+import pakcrypt
+import pakhash
+
+TEMPLATE_SHARD_SIZE = 0x4000
+
+# Shards handed to every worker process ahead of the ones being collected
+TEMPLATE_PENDING_PER_JOB = 4
+
+# Upper bound on the bytes pulled from one pack per batch of extracted entries
+EXTRACT_BATCH_SIZE = 0x4000000
+
+# Number of lines in the summary written for every profiled phase
+PROFILE_TOP = 30
+
+# Only every this many runs of a phase are snapshotted when profiling memory
+PROFILE_SNAPSHOT_RATE = 16
+
+# Number of reusable read buffers, so one batch can be read while the entries
+# of the previous one are still being written out
+EXTRACT_BUFFERS = 2
+
+# Threads writing extracted entries to disk
+EXTRACT_WORKERS = 4
+
+# Threads hashing extracted entries, and how many hashes may be in flight
+# before extraction waits for the oldest one
+VERIFY_WORKERS = 4
+VERIFY_MAX_PENDING = 64
+
+# In sample mode only every Nth entry is verified
+VERIFY_SAMPLE_RATE = 16
+
+# Magics of formats commonly stored in the packs, used to tell encrypted
+# entries from plain ones without hashing the whole entry
+HEADER_MAGICS = [
+    b"\x00\x00\x01\xba", # PSS (MPEG pack header)
+    b"\x10\x00\x00\x00", # TIM
+    b"TSLF",
+]
+
+# Bytes decrypted per entry when sniffing the header, kept word aligned so
+# the partial word handling never kicks in
+SNIFF_SIZE = 0x10
+
+# One packinfo.bin record, md5sum followed by key1 (CRC32 filename hash),
+# key2 (CRC16 filename hash), packid, offset and filesize
+PACK_ENTRY_DTYPE = np.dtype([
+    ('md5sum', 'V16'),
+    ('key1', '<u4'),
+    ('key2', '<u2'),
+    ('packid', '<u2'),
+    ('offset', '<u4'),
+    ('filesize', '<u4'),
+])
+
+class PackPool:
+    # Keeps a bounded LRU of memory-mapped packs so each .pak is mapped once
+    # instead of being read in full for every entry pulled out of it
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self.maps = OrderedDict()
+
+
+    def get(self, packpath):
+        if packpath in self.maps:
+            self.maps.move_to_end(packpath)
+            return self.maps[packpath]
+
+        with open(packpath, "rb") as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                packmap = b""
+
+            else:
+                packmap = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.maps[packpath] = packmap
+
+        while len(self.maps) > self.max_open:
+            _, old_map = self.maps.popitem(last=False)
+            self.release(old_map)
+
+        return packmap
+
+
+    def view(self, packpath, offset, size):
+        return memoryview(self.get(packpath))[offset:offset+size]
+
+
+    def release(self, packmap):
+        if isinstance(packmap, mmap.mmap):
+            try:
+                packmap.close()
+
+            except BufferError:
+                # Views handed out earlier are still alive, the map gets
+                # closed when the last of them is garbage collected
+                pass
+
+
+    def close(self):
+        while self.maps:
+            _, packmap = self.maps.popitem()
+            self.release(packmap)
+
+
+class PackReader:
+    # Reads the span of a pack covered by a batch of entries with a single
+    # readinto into one of a few reusable buffers. Batches come in pack and
+    # offset order, so every pack is read front to back exactly once
+    def __init__(self, slots=EXTRACT_BUFFERS):
+        self.buffers = [bytearray() for _ in range(slots)]
+        self.packpath = None
+        self.infile = None
+
+
+    def read(self, packpath, offset, size, slot=0):
+        if packpath != self.packpath:
+            self.close()
+            self.infile = open(packpath, "rb", buffering=0)
+            self.packpath = packpath
+
+        if len(self.buffers[slot]) < size:
+            # Views of the old buffer may still be around, so grow it by
+            # swapping in a new one rather than resizing in place
+            self.buffers[slot] = bytearray(size)
+
+        data = memoryview(self.buffers[slot])[:size]
+
+        self.infile.seek(offset)
+        size = self.infile.readinto(data)
+
+        return data[:size]
+
+
+    def close(self):
+        if self.infile is not None:
+            self.infile.close()
+
+        self.packpath = None
+        self.infile = None
+
+
+class PakEntryFile(io.RawIOBase):
+    # Read-only file object over one pack entry that decrypts one chunk at
+    # a time, so memory use doesn't depend on the size of the entry
+    def __init__(self, data, keystream=None, chunk_size=pakcrypt.CHECKPOINT_WORDS * 4):
+        self.data = data
+        self.keystream = keystream
+        self.chunk_size = chunk_size
+        self.pos = 0
+        self.chunk_start = None
+        self.chunk = None
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def tell(self):
+        return self.pos
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+
+        elif whence == io.SEEK_END:
+            offset += len(self.data)
+
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+
+        self.pos = offset
+
+        return self.pos
+
+
+    def load_chunk(self, chunk_start):
+        # Chunks start on keystream checkpoints, so decrypting one never
+        # replays keys from an earlier chunk
+        if chunk_start != self.chunk_start:
+            self.chunk = bytearray(self.data[chunk_start:chunk_start+self.chunk_size])
+
+            if self.keystream is not None:
+                self.keystream.decrypt(self.chunk, chunk_start, len(self.data))
+
+            self.chunk_start = chunk_start
+
+        return self.chunk
+
+
+    def readinto(self, buffer):
+        if self.pos >= len(self.data):
+            return 0
+
+        chunk_start = self.pos - self.pos % self.chunk_size
+        chunk = self.load_chunk(chunk_start)
+
+        start = self.pos - chunk_start
+        size = min(len(buffer), len(chunk) - start)
+        buffer[:size] = chunk[start:start+size]
+        self.pos += size
+
+        return size
+
+
+    def close(self):
+        self.data = None
+        self.chunk = None
+        super().close()
+
+
+class Verifier:
+    # Checks the MD5 of extracted entries on a thread pool so it overlaps
+    # with extraction (hashlib drops the GIL while hashing). Mismatches are
+    # collected for a report instead of being printed as they are found
+    def __init__(self, mode="full", sample_rate=VERIFY_SAMPLE_RATE, workers=VERIFY_WORKERS, metrics=None):
+        self.mode = mode
+        self.metrics = metrics
+        self.sample_rate = sample_rate
+        self.pool = ThreadPoolExecutor(workers) if mode != "none" else None
+        self.pending = deque()
+        self.mismatches = []
+        self.seen = 0
+        self.submitted = 0
+        self.checked = 0
+
+
+    def wants(self):
+        if self.mode == "none":
+            return False
+
+        self.seen += 1
+
+        return self.mode == "full" or (self.seen - 1) % self.sample_rate == 0
+
+
+    def submit(self, data, entry):
+        # Returns the future of the MD5, or None if the entry isn't checked
+        if not self.wants():
+            return None
+
+        future = self.pool.submit(self.hash, data)
+        self.pending.append((future, entry))
+        self.submitted += 1
+
+        while len(self.pending) > VERIFY_MAX_PENDING:
+            self.check(*self.pending.popleft())
+
+        return future
+
+
+    def hash(self, data):
+        start = time.perf_counter()
+        md5sum = hashlib.md5(data)
+
+        if self.metrics is not None:
+            self.metrics.add("md5", time.perf_counter() - start, len(data), 1)
+
+        return md5sum
+
+
+    def check(self, future, entry):
+        md5sum = future.result().digest()
+        self.checked += 1
+
+        if md5sum != entry['md5sum']:
+            self.mismatches.append({
+                'filename': entry.get('orig_filename'),
+                'key1': "%08x" % entry['key1'],
+                'packid': entry['packid'],
+                'offset': entry['offset'],
+                'filesize': entry['filesize'],
+                'expected': entry['md5sum'].hex(),
+                'actual': md5sum.hex(),
+            })
+
+
+    def wait(self, upto=None):
+        # Finishes the checks of everything submitted before upto
+        while self.pending and (upto is None or self.checked < upto):
+            self.check(*self.pending.popleft())
+
+
+    def report(self):
+        # Returns the mismatches found since the last report
+        self.wait()
+
+        mismatches = self.mismatches
+        self.mismatches = []
+
+        return mismatches
+
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+class Manifest:
+    # Lines of JSON, one per file written, appended as soon as the file is
+    # complete so an interrupted run knows which outputs can be kept
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.root = os.path.dirname(path)
+        self.records = {}
+        self.lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            with open(path, "r") as infile:
+                for line in infile:
+                    try:
+                        record = json.loads(line)
+
+                    except ValueError:
+                        # Last line of a run that got killed mid-write
+                        continue
+
+                    self.records[record['key1']] = record
+
+        os.makedirs(self.root or ".", exist_ok=True)
+        self.outfile = open(path, "a" if resume else "w")
+
+
+    def is_done(self, entry, output_filename):
+        record = self.records.get("%08x" % entry['key1'])
+
+        if record is None or record['md5'] != entry['md5sum'].hex():
+            return False
+
+        if record['path'] != os.path.relpath(output_filename, self.root or "."):
+            return False
+
+        return os.path.isfile(output_filename) and os.path.getsize(output_filename) == record['size']
+
+
+    def add(self, entry, output_filename):
+        record = {
+            'key1': "%08x" % entry['key1'],
+            'path': os.path.relpath(output_filename, self.root or "."),
+            'size': os.path.getsize(output_filename),
+            'md5': entry['md5sum'].hex(),
+        }
+
+        with self.lock:
+            self.outfile.write(json.dumps(record) + "\n")
+            self.outfile.flush()
+            self.records[record['key1']] = record
+
+
+    def close(self):
+        self.outfile.close()
+
+
+    def __getstate__(self):
+        # Worker processes append to the same file through their own handle
+        return (self.path, self.records)
+
+
+    def __setstate__(self, state):
+        self.path, self.records = state
+        self.root = os.path.dirname(self.path)
+        self.lock = threading.Lock()
+        self.outfile = open(self.path, "a")
+
+
+class BlobStore:
+    # Keeps every distinct payload once, named by its MD5 from packinfo.bin,
+    # so dumps of several game versions can hardlink the files they share
+    def __init__(self, root):
+        self.root = root
+        self.known = set()
+
+        os.makedirs(root, exist_ok=True)
+
+        for folder in os.scandir(root):
+            if folder.is_dir():
+                self.known.update(x.name for x in os.scandir(folder.path) if not x.name.endswith(".tmp"))
+
+
+    def get_path(self, md5sum):
+        return os.path.join(self.root, md5sum.hex()[:2], md5sum.hex())
+
+
+    def has(self, md5sum):
+        return md5sum.hex() in self.known
+
+
+    def put(self, md5sum, data, digest=None):
+        # Only payloads that really hash to their key go in the store. digest
+        # is the MD5 of data if the caller already has it
+        if digest is None:
+            digest = hashlib.md5(data).digest()
+
+        if digest != md5sum:
+            return False
+
+        path = self.get_path(md5sum)
+        temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(temp_path, "wb") as outfile:
+            outfile.write(data)
+
+        os.replace(temp_path, path)
+        self.known.add(md5sum.hex())
+
+        return True
+
+
+    def read(self, md5sum):
+        with open(self.get_path(md5sum), "rb") as infile:
+            return infile.read()
+
+
+    def link(self, md5sum, output_filename):
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+
+        if os.path.lexists(output_filename):
+            os.remove(output_filename)
+
+        try:
+            os.link(self.get_path(md5sum), output_filename)
+
+        except OSError:
+            # Store and output are on different filesystems
+            shutil.copyfile(self.get_path(md5sum), output_filename)
+
+
+class Metrics:
+    # Time, bytes and item counts per phase of a run. count is entries for
+    # every phase except bruteforce, where it is the candidates checked and
+    # hits the ones that matched. Phases that run on several threads add up
+    # the time of all of them, so they can take longer than the whole run
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.phases = OrderedDict()
+        self.start = time.perf_counter()
+        self.last_progress = self.start
+        self.done = 0
+        self.done_size = 0
+
+
+    @contextlib.contextmanager
+    def phase(self, name, size=0, count=0):
+        start = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.add(name, time.perf_counter() - start, size, count)
+
+
+    def add(self, name, seconds=0.0, size=0, count=0, hits=0):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'count': 0, 'hits': 0})
+            phase['seconds'] += seconds
+            phase['bytes'] += int(size)
+            phase['count'] += int(count)
+            phase['hits'] += int(hits)
+
+
+    def collect(self):
+        # Returns the phases recorded since the last collect, for worker
+        # processes to send back and merge
+        with self.lock:
+            phases = self.phases
+            self.phases = OrderedDict()
+
+        return phases
+
+
+    def merge(self, phases):
+        for name, phase in phases.items():
+            self.add(name, phase['seconds'], phase['bytes'], phase['count'], phase['hits'])
+
+
+    def advance(self, count, size):
+        # Counts extracted entries and prints a progress line every
+        # self.progress seconds
+        now = time.perf_counter()
+
+        with self.lock:
+            self.done += count
+            self.done_size += size
+
+            if self.progress is None or now - self.last_progress < self.progress:
+                return
+
+            self.last_progress = now
+
+        print("Progress: %d entries, %.1f MB, %.1f MB/s" % (self.done, self.done_size / 0x100000, self.done_size / 0x100000 / (now - self.start)))
+
+
+    def report(self):
+        output = OrderedDict()
+        output['seconds'] = time.perf_counter() - self.start
+        output['phases'] = OrderedDict()
+
+        for name, phase in self.phases.items():
+            phase = dict(phase)
+            seconds = phase['seconds']
+
+            phase['mb_per_sec'] = phase['bytes'] / 0x100000 / seconds if seconds and phase['bytes'] else None
+            phase['per_sec'] = phase['count'] / seconds if seconds and phase['count'] else None
+
+            if name == "bruteforce":
+                phase['hit_rate'] = phase['hits'] / phase['count'] if phase['count'] else None
+
+            else:
+                del phase['hits']
+
+            output['phases'][name] = phase
+
+        return output
+
+
+class Profiler:
+    # Runs named phases under cProfile or tracemalloc and writes a stats file
+    # and a top-N summary for each of them. Phases have to run on the thread
+    # that profiles them. A phase started inside another one pauses it, so
+    # every profile only holds the work of its own phase. The cProfile runs
+    # of a phase that runs many times are added together, for tracemalloc
+    # its highest peak is kept along with the sampled run that grew memory
+    # the most
+    def __init__(self, mode=None, path="profile", top=PROFILE_TOP):
+        self.mode = mode
+        self.path = path
+        self.top = top
+        self.stack = []
+        self.runs = {}
+        self.results = OrderedDict()
+
+        if mode == "mem":
+            tracemalloc.start()
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.mode is None:
+            yield
+            return
+
+        run = self.runs.get(name, 0)
+        self.runs[name] = run + 1
+
+        if self.mode == "cpu":
+            profile = cProfile.Profile()
+
+            if self.stack:
+                self.stack[-1].disable()
+
+            self.stack.append(profile)
+            profile.enable()
+
+            try:
+                yield
+
+            finally:
+                profile.disable()
+                self.stack.pop()
+
+                if self.stack:
+                    self.stack[-1].enable()
+
+                self.add_cpu(name, profile)
+
+        else:
+            # Two snapshots of the whole heap are too slow to take around
+            # every run of a phase such as demux, so only some runs get them
+            start = tracemalloc.take_snapshot() if run % PROFILE_SNAPSHOT_RATE == 0 else None
+
+            if self.stack:
+                # The outer phase's peak so far is lost when it is reset
+                self.stack[-1][0] = max(self.stack[-1][0], tracemalloc.get_traced_memory()[1])
+
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            self.stack.append([0])
+
+            try:
+                yield
+
+            finally:
+                peak = max(self.stack.pop()[0], tracemalloc.get_traced_memory()[1])
+
+                if self.stack:
+                    self.stack[-1][0] = max(self.stack[-1][0], peak)
+
+                end = tracemalloc.take_snapshot() if start is not None else None
+                self.add_mem(name, peak, peak - base, start, end)
+
+
+    def add_cpu(self, name, profile):
+        if name in self.results:
+            self.results[name].add(profile)
+
+        else:
+            self.results[name] = pstats.Stats(profile)
+
+
+    def add_mem(self, name, peak, increase, start, end):
+        result = self.results.setdefault(name, {'runs': 0, 'peak': 0, 'increase': 0, 'snapshot': None, 'diff': [], 'growth': 0})
+        result['runs'] += 1
+
+        if result['runs'] == 1 or increase > result['increase']:
+            result['peak'] = peak
+            result['increase'] = increase
+
+        if start is None:
+            return
+
+        # Leaves out what tracemalloc allocated for its own snapshots
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        end = end.filter_traces(ignore)
+        diff = end.compare_to(start.filter_traces(ignore), "lineno")
+        growth = sum(stat.size_diff for stat in diff)
+
+        if result['snapshot'] is None or growth > result['growth']:
+            result['snapshot'] = end
+            result['diff'] = diff
+            result['growth'] = growth
+
+
+    def close(self):
+        if self.mode is None:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+
+        for name, result in self.results.items():
+            summary_path = os.path.join(self.path, "%s.txt" % name)
+
+            if self.mode == "cpu":
+                stats_path = os.path.join(self.path, "%s.prof" % name)
+                result.dump_stats(stats_path)
+
+                with open(summary_path, "w") as outfile:
+                    pstats.Stats(stats_path, stream=outfile).sort_stats("cumulative").print_stats(self.top)
+
+            else:
+                stats_path = os.path.join(self.path, "%s.tracemalloc" % name)
+                result['snapshot'].dump(stats_path)
+
+                with open(summary_path, "w") as outfile:
+                    outfile.write("Runs: %d (snapshots of every %d)\n" % (result['runs'], PROFILE_SNAPSHOT_RATE))
+                    outfile.write("Peak traced memory: %.1f MB (%.1f MB above the start of the run)\n" % (result['peak'] / 0x100000, result['increase'] / 0x100000))
+                    outfile.write("Memory growth: %.1f MB\n\n" % (result['growth'] / 0x100000))
+
+                    for stat in result['diff'][:self.top]:
+                        outfile.write("%s\n" % stat)
+
+            print("Wrote %s profile of %s to %s" % (self.mode, name, stats_path))
+
+        if self.mode == "mem":
+            tracemalloc.stop()
+
+        self.results = OrderedDict()
+
+
 class PakDumper:
-    def __init__(self, packinfo, demux, fast):
-        self.entries = self.parse_pack_data(packinfo)
-        self.packlist = self.generate_packlist()
+    def __init__(self, packinfo, input_path, demux, decrypt_backend="auto", jobs=1, verify="full", keep_pss=True, store=None, hash_backend="auto", calibrate=False, profiler=None):
+        self.metrics = Metrics()
+        self.profiler = profiler if profiler is not None else Profiler()
+
+        with self.metrics.phase("index", os.path.getsize(packinfo)), self.profiler.phase("parse_pack_data"):
+            self.entries = self.parse_pack_data(packinfo)
+
+        self.names = np.full(len(self.entries), None, dtype=object)
+        self.extract_order = np.lexsort((self.entries['offset'], self.entries['packid']))
+        self.packinfo_md5 = self.get_md5sum(open(packinfo, "rb").read()).hex()
+        self.key_arrays = (np.ascontiguousarray(self.entries['key1']), np.ascontiguousarray(self.entries['key2']))
+        self.input_path = input_path
+        self.packlist, self.pack_present = self.generate_packlist(input_path)
         self.crc32_tab = self.generate_crc32_table()
         self.demux = demux
-        self.fast = fast
+        self.keep_pss = keep_pss
+        self.decrypt_backend, self.decrypt_impl = pakbackend.select_decrypt(decrypt_backend, calibrate)
+        self.hash_backend, self.hash_impl = pakbackend.select_hash(hash_backend, calibrate)
+        self.jobs = jobs
+        self.store = store
+        self.pack_pool = PackPool()
+        self.verifier = Verifier(verify, metrics=self.metrics)
+        self.metrics.add("index", count=len(self.entries))
+
+
+    def __getstate__(self):
+        # Open packs and thread pools stay behind when sent to a worker,
+        # which also starts its metrics from scratch and isn't profiled
+        state = self.__dict__.copy()
+        state['pack_pool'] = None
+        state['verifier'] = self.verifier.mode
+        state['metrics'] = None
+        state['profiler'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pack_pool = PackPool()
+        self.metrics = Metrics()
+        self.profiler = Profiler()
+        self.verifier = Verifier(state['verifier'], metrics=self.metrics)
 
 
     def generate_crc32_table(self):
@@ -138,42 +857,100 @@ class PakDumper:
 
 
     def parse_pack_data(self, filename):
-        entries = {}
-
+        # The whole table is read into a structured array sorted by key1 so
+        # that lookups are a searchsorted away
         with open(filename, "rb") as infile:
-            infile.seek(0x08)
-            end_addr = int.from_bytes(infile.read(4), 'little')
-            infile.seek(0x10)
+            data = infile.read()
 
-            while infile.tell() < end_addr:
-                md5sum = infile.read(0x10)
-                data = infile.read(0x10)
+        end_addr = int.from_bytes(data[0x08:0x0c], 'little')
+        count = -(-(end_addr - 0x10) // PACK_ENTRY_DTYPE.itemsize)
+        count = max(0, min(count, (len(data) - 0x10) // PACK_ENTRY_DTYPE.itemsize))
+        records = np.frombuffer(data, dtype=PACK_ENTRY_DTYPE, count=count, offset=0x10)
 
-                if not md5sum or not data:
-                    break
+        # Records are applied in file order like a dict keyed by key1: a
+        # record replaces the stored one unless it repeats the same key2
+        records = records[np.argsort(records['key1'], kind='stable')]
+        new_run = np.ones(len(records), dtype=bool)
+        new_run[1:] = (records['key1'][1:] != records['key1'][:-1]) | (records['key2'][1:] != records['key2'][:-1])
+
+        for record in records[~new_run]:
+            print("Found key already: key1[%08x] key2[%04x]" % (record['key1'], record['key2']))
+
+        starts = np.nonzero(new_run)[0]
+        last_starts = starts[np.append(records['key1'][starts[1:]] != records['key1'][starts[:-1]], True)]
+
+        return records[last_starts]
+
+
+    def find_entry(self, filename_hash):
+        idx = int(np.searchsorted(self.entries['key1'], filename_hash))
+
+        if idx < len(self.entries) and self.entries['key1'][idx] == filename_hash:
+            return idx
+
+        return None
+
+
+    def extract_batches(self, order=None):
+        # Entries in extraction order, split per pack and capped in size
+        batch = []
+        batch_size = 0
+
+        for idx in self.extract_order if order is None else order:
+            if batch and (self.entries['packid'][idx] != self.entries['packid'][batch[0]] or batch_size + self.entries['filesize'][idx] > EXTRACT_BATCH_SIZE):
+                yield batch
+                batch = []
+                batch_size = 0
+
+            batch.append(idx)
+            batch_size += int(self.entries['filesize'][idx])
+
+        if batch:
+            yield batch
+
+
+    def get_entry(self, idx):
+        record = self.entries[idx]
 
-                key1, key2, packid, offset, filesize = struct.unpack("<IHHII", data)
+        entry = {
+            'key1': int(record['key1']),
+            'key2': int(record['key2']),
+            'packid': int(record['packid']),
+            'offset': int(record['offset']),
+            'filesize': int(record['filesize']),
+            'md5sum': record['md5sum'].tobytes(),
+        }
 
-                entry = {
-                    'key1': key1, # CRC32 filename hash
-                    'key2': key2, # CRC16 filename hash
-                    'packid': packid,
-                    'offset': offset,
-                    'filesize': filesize,
-                    'md5sum': md5sum,
-                }
+        if self.names[idx] is not None:
+            entry['orig_filename'] = self.names[idx]
 
-                if key1 in entries and entries[key1]['key2'] == key2:
-                    print("Found key already:", entries[key1])
-                    continue
+        return entry
 
-                entries[key1] = entry
 
-        return entries
+    def scan_packs(self, input_path):
+        # Lists every file in the pack folders with one scandir per folder
+        # instead of checking each of the 3000 pack slots
+        found = set()
 
+        for pack_folder in ["data/pack", "data/pack_v3"]:
+            try:
+                folders = [x for x in os.scandir(os.path.join(input_path, pack_folder)) if x.is_dir()]
 
-    def generate_packlist(self):
+            except FileNotFoundError:
+                continue
+
+            for folder in folders:
+                for x in os.scandir(folder.path):
+                    if x.is_file():
+                        found.add("%s/%s/%s" % (pack_folder, folder.name, x.name))
+
+        return found
+
+
+    def generate_packlist(self, input_path):
         packlist = []
+        pack_present = np.zeros(3000, dtype=bool)
+        found = self.scan_packs(input_path)
 
         cur_folder = 0
         for i in range(0, 3000):
@@ -184,130 +961,623 @@ class PakDumper:
             p1 = "data/pack/d%03d/pack%04d.pak" % (cur_folder, i)
             p2 = "data/pack_v3/d%03d/pack%04d.pak" % (cur_folder, i)
 
-            if os.path.exists(p2):
-                packlist.append(p2)
+            if p2 in found:
+                packlist.append(os.path.join(input_path, p2))
 
             else:
-                packlist.append(p1)
+                packlist.append(os.path.join(input_path, p1))
 
-        return packlist
+            pack_present[i] = p1 in found or p2 in found
 
-
-    def rol(self, val, r_bits):
-        return (val << r_bits) & 0xFFFFFFFF | ((val & 0xFFFFFFFF) >> (32 - r_bits))
+        return packlist, pack_present
 
 
     def decrypt(self, data, key1, key2):
-        if self.fast:
-            # Uses a Cython module for fast decryption
-            import pakdec
-            pakdec.decrypt(data, len(data), key1, key2)
-            return data
+        return self.decrypt_many([data], [key1], [key2])[0]
 
-        key = key1
 
-        for i in range(0, int(len(data) / 4) * 4, 4):
-            key = self.rol(key + key2, 3)
+    def decrypt_many(self, buffers, key1s, key2s):
+        return self.decrypt_impl(buffers, key1s, key2s)
 
-            data[i] ^= key & 0xff
-            data[i + 1] ^= (key >> 8) & 0xff
-            data[i + 2] ^= (key >> 16) & 0xff
-            data[i + 3] ^= (key >> 24) & 0xff
 
-        i += 4
+    def file_exists(self, input):
+        idx = self.find_entry(self.calculate_filename_hash(input))
 
-        key = self.rol(key + key2, 3)
-        parts = [key & 0xff, (key >> 8) & 0xff, (key >> 16) & 0xff, (key >> 24) & 0xff]
-        for j in range(len(data) - i):
-                data[i] ^= parts[j]
+        # The CRC16s are only worth computing once the CRC32 is known to hit
+        exists = idx is not None and self.entries['key2'][idx] in [self.calculate_filename_hash_crc16(input), self.calculate_filename_hash_crc16_cs(input)]
 
-        return data
+        if exists:
+            self.names[idx] = input
 
+        return exists
 
-    def file_exists(self, input):
-        filename_hash = self.calculate_filename_hash(input)
-        filename_hash_crc16 = self.calculate_filename_hash_crc16(input)
-        filename_hash_crc16_2 = self.calculate_filename_hash_crc16_cs(input)
-        exists = filename_hash in self.entries and self.entries[filename_hash]['key2'] in [filename_hash_crc16, filename_hash_crc16_2]
 
-        if exists:
-            self.entries[filename_hash]['orig_filename'] = input
+    def hash_many(self, inputs):
+        crc32_many, crc16_many = self.hash_impl
+        inputs = list(inputs)
+        return (crc32_many(inputs),) + crc16_many(inputs)
+
+
+    def file_exists_many(self, inputs):
+        inputs = list(inputs)
+        exists = np.zeros(len(inputs), dtype=bool)
+
+        for idx, entry_idx in zip(*pakhash.match_filenames(*self.key_arrays, inputs, *self.hash_impl)):
+            self.names[entry_idx] = inputs[idx]
+            exists[idx] = True
+
+        self.metrics.add("bruteforce", count=len(inputs), hits=np.count_nonzero(exists))
 
         return exists
 
 
+    def template_shards(self, templates):
+        # Rows are only pulled out of the iterators one shard at a time
+        for template, rows in templates:
+            rows = iter(rows)
+
+            while True:
+                chunk = list(itertools.islice(rows, TEMPLATE_SHARD_SIZE))
+
+                if not chunk:
+                    break
+
+                yield template, pakhash.rows_to_columns(chunk), len(chunk)
+
+
+    def match_template_shards(self, shards):
+        # Yields the size and matches of every shard in order. With more than
+        # one job a bounded number of shards is hashed ahead on worker
+        # processes, so the candidates never all sit in memory at once
+        shards = iter(shards)
+        first = list(itertools.islice(shards, 2))
+
+        if self.jobs < 2 or len(first) < 2:
+            for template, columns, count in itertools.chain(first, shards):
+                yield count, pakhash.find_template_matches(template, columns, count, *self.key_arrays)
+
+            return
+
+        with ProcessPoolExecutor(self.jobs, initializer=pakhash.init_template_worker, initargs=self.key_arrays) as executor:
+            pending = deque()
+
+            for template, columns, count in itertools.chain(first, shards):
+                pending.append((count, executor.submit(pakhash.template_worker, template, columns, count)))
+
+                if len(pending) >= self.jobs * TEMPLATE_PENDING_PER_JOB:
+                    count, future = pending.popleft()
+                    yield count, future.result()
+
+            while pending:
+                count, future = pending.popleft()
+                yield count, future.result()
+
+
+    def templates_exist_many(self, templates):
+        # Only the candidates that exist are ever formatted into strings
+        filenames = []
+        candidates = 0
+
+        for count, matches in self.match_template_shards(self.template_shards(templates)):
+            candidates += count
+
+            for filename, entry_idx in matches:
+                self.names[entry_idx] = filename
+                filenames.append(filename)
+
+        self.metrics.add("bruteforce", count=candidates, hits=len(filenames))
+
+        return filenames
+
+
+    def solve_filenames(self, prefix, ext, charset, max_length):
+        # Recovers names of the form prefix + middle + ext for entries that
+        # are still unnamed by inverting the CRC32, then confirms the
+        # candidates against key2
+        unknown = self.entries['key1'][self.unnamed()]
+        filenames = []
+
+        for length in range(0, max_length + 1):
+            for filename_hash, middle in pakhash.solve_crc32(prefix, ext, unknown, charset, length):
+                filename = prefix + middle + ext
+
+                if self.names[self.find_entry(filename_hash)] is None and self.file_exists(filename):
+                    filenames.append(filename)
+
+        return filenames
+
+
+    def unnamed(self):
+        return np.array([name is None for name in self.names], dtype=bool)
+
+
+    def load_name_cache(self, path):
+        # The cache is only valid for the exact packinfo.bin it was built from
+        try:
+            with open(path, "r") as infile:
+                cache = json.load(infile)
+
+        except (OSError, ValueError):
+            return None
+
+        if cache.get('packinfo_md5') != self.packinfo_md5:
+            return None
+
+        filenames = []
+        for k, filename in cache.get('names', {}).items():
+            idx = self.find_entry(int(k, 16))
+
+            if idx is not None:
+                self.names[idx] = filename
+                filenames.append(filename)
+
+        return filenames
+
+
+    def save_name_cache(self, path):
+        cache = {
+            'packinfo_md5': self.packinfo_md5,
+            'names': {"%08x" % self.entries['key1'][idx]: self.names[idx] for idx in np.nonzero(~self.unnamed())[0]},
+        }
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "w") as outfile:
+            json.dump(cache, outfile, indent=4, sort_keys=True)
+
+
+    def write_catalog(self, path):
+        # Dumps the index and the resolved names into SQLite so the contents
+        # of the packs can be queried without extracting anything
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        conn = sqlite3.connect(path)
+
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS entries")
+            conn.execute("DROP TABLE IF EXISTS info")
+            conn.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE entries (key1 INTEGER PRIMARY KEY, key2 INTEGER, packid INTEGER, offset INTEGER, filesize INTEGER, md5sum TEXT, filename TEXT)")
+
+            conn.execute("INSERT INTO info VALUES ('packinfo_md5', ?)", (self.packinfo_md5,))
+            conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                (int(entry['key1']), int(entry['key2']), int(entry['packid']), int(entry['offset']), int(entry['filesize']), bytes(entry['md5sum']).hex(), name)
+                for entry, name in zip(self.entries, self.names)
+            ))
+
+            conn.execute("CREATE INDEX entries_pack ON entries (packid, offset)")
+            conn.execute("CREATE INDEX entries_filename ON entries (filename)")
+            conn.execute("CREATE INDEX entries_md5sum ON entries (md5sum)")
+
+        conn.close()
+
+
     def get_md5sum(self, data):
         md5 = hashlib.md5()
         md5.update(data)
         return md5.digest()
 
 
-    def extract_data_mem(self, path, input_path="", filename_hash=None):
+    def extract_data_mem(self, path, filename_hash=None):
         if filename_hash is None:
             filename_hash = self.calculate_filename_hash(path)
 
-        if filename_hash not in self.entries:
+        idx = self.find_entry(filename_hash)
+
+        if idx is None:
             print("Couldn't find entry for", path)
             return None
 
-        entry = self.entries[filename_hash]
+        return self.extract_data_mem_many([idx])[0]
+
+
+    def is_known_header(self, data, filesize):
+        if bytes(data[:4]) in HEADER_MAGICS:
+            return True
+
+        # FCN archives start with their own size
+        return len(data) >= 4 and int.from_bytes(data[:4], 'little') == filesize
+
 
-        if entry['packid'] > len(self.packlist):
-            print("[BAD PACK_ID] pack_id: %d, data_offset: %08x, data_size: %08x, filename: %s" % (entry['packid'], entry['offset'], entry['filesize'], path))
+    def sniff_encryption(self, views, entries):
+        # Decrypts only the first few words of every entry and looks for known
+        # magics. Gives True/False when exactly one of the raw and decrypted
+        # headers is recognised and None when that is ambiguous
+        sniffable = [i for i, view in enumerate(views) if len(view) >= SNIFF_SIZE]
+        headers = self.decrypt_many([bytearray(views[i][:SNIFF_SIZE]) for i in sniffable], [entries[i]['key1'] for i in sniffable], [entries[i]['key2'] for i in sniffable])
+
+        output = [None] * len(views)
+
+        for i, header in zip(sniffable, headers):
+            plain = self.is_known_header(views[i], entries[i]['filesize'])
+            decrypted = self.is_known_header(header, entries[i]['filesize'])
+
+            if plain != decrypted:
+                output[i] = decrypted
+
+        return output
+
+
+    def get_pack_path(self, entry):
+        if entry['packid'] >= len(self.packlist):
+            print("[BAD PACK_ID] pack_id: %d, data_offset: %08x, data_size: %08x, filename: %s" % (entry['packid'], entry['offset'], entry['filesize'], entry.get('orig_filename')))
             return None
 
         packpath = self.packlist[entry['packid']]
-        if packpath.startswith('/'):
-            packpath = packpath[1:]
-
-        packpath = os.path.join(input_path, packpath)
 
-        if not os.path.exists(packpath):
+        if not self.pack_present[entry['packid']]:
             print("Could not find %s" % packpath)
             return None
 
-        data = bytearray(open(packpath, "rb").read()[entry['offset']:entry['offset']+entry['filesize']])
+        return packpath
 
-        encryption = False
-        if self.get_md5sum(data) != entry['md5sum']:
-            encryption = True
 
-        if encryption:
-            decrypted = self.decrypt(data, entry['key1'], entry['key2'])
+    def open(self, path, filename_hash=None):
+        # Like extract_data_mem but returns a seekable file object that
+        # decrypts as it is read
+        if filename_hash is None:
+            filename_hash = self.calculate_filename_hash(path)
 
-        else:
-            decrypted = data
+        idx = self.find_entry(filename_hash)
+
+        if idx is None:
+            print("Couldn't find entry for", path)
+            return None
+
+        entry = self.get_entry(idx)
+        packpath = self.get_pack_path(entry)
 
-        if self.get_md5sum(data) != entry['md5sum']:
-            print("Bad checksum for", path)
+        if packpath is None:
+            return None
+
+        data = self.pack_pool.view(packpath, entry['offset'], entry['filesize'])
+        encryption = self.sniff_encryption([data], [entry])[0]
+
+        if encryption is None:
+            encryption = self.get_md5sum(data) != entry['md5sum']
+
+        return io.BufferedReader(PakEntryFile(data, pakcrypt.Keystream(entry['key1'], entry['key2']) if encryption else None))
 
-        return decrypted
 
+    def extract_data_mem_many(self, idxs, reader=None, slot=0, checks=None):
+        # Pulls several entries at once so that all encrypted ones can be
+        # decrypted together as lanes of one batch. With a reader the entries
+        # must come from one pack in offset order, and are read in one go.
+        # checks gets the MD5 of every entry that was hashed along the way,
+        # as a digest or the future of one, and None for the others
+        output = [None] * len(idxs)
+        checks = [None] * len(idxs) if checks is None else checks
+        found = []
+        encrypted = []
+        in_place = False
 
-    def extract_data(self, path, input_path, output_path):
-        data = self.extract_data_mem(path, input_path)
+        for i, idx in enumerate(idxs):
+            entry = self.get_entry(idx)
+            packpath = self.get_pack_path(entry)
+
+            if packpath is None:
+                continue
+
+            if reader is None:
+                found.append((i, entry, self.pack_pool.view(packpath, entry['offset'], entry['filesize'])))
+
+            else:
+                found.append((i, entry, packpath))
+
+        if reader is not None and found:
+            start = found[0][1]['offset']
+            end = max(entry['offset'] + entry['filesize'] for _, entry, _ in found)
+
+            with self.metrics.phase("pack_io", end - start, len(found)):
+                span = reader.read(found[0][2], start, end - start, slot)
+
+            found = [(i, entry, span[entry['offset']-start:entry['offset']-start+entry['filesize']]) for i, entry, _ in found]
+
+            # The read buffer can be decrypted directly unless entries share
+            # bytes
+            in_place = all(a[1]['offset'] + a[1]['filesize'] <= b[1]['offset'] for a, b in zip(found, found[1:]))
+
+        sniffed = self.sniff_encryption([data for _, _, data in found], [entry for _, entry, _ in found])
+
+        for (i, entry, data), encryption in zip(found, sniffed):
+            if encryption is None:
+                # Fall back to hashing the raw entry, a match also verifies it
+                with self.metrics.phase("md5", len(data), 1):
+                    checks[i] = self.get_md5sum(data)
+
+                encryption = checks[i] != entry['md5sum']
+
+            elif not encryption:
+                checks[i] = self.verifier.submit(data, entry)
+
+            if encryption:
+                if not in_place:
+                    # Pack maps are read-only so decryption needs its own copy
+                    data = bytearray(data)
+
+                encrypted.append((i, data, entry))
+
+            output[i] = data
+
+        with self.metrics.phase("decrypt", sum(len(data) for _, data, _ in encrypted), len(encrypted)):
+            self.decrypt_many([data for _, data, _ in encrypted], [entry['key1'] for _, _, entry in encrypted], [entry['key2'] for _, _, entry in encrypted])
+
+        for i, data, entry in encrypted:
+            checks[i] = self.verifier.submit(data, entry)
+
+        return output
+
+
+    def extract_data(self, path, output_path, data=None):
+        if data is None:
+            data = self.extract_data_mem(path)
+
+        if path.startswith('/'):
+            path = path[1:]
+
+        self.write_entry(os.path.join(output_path, path), data)
+
+        return True
+
+
+    def get_output_filename(self, output_path, idx):
+        path = self.names[idx]
+
+        if path is None:
+            return os.path.join(output_path, "unknown", "%08x.bin" % self.entries['key1'][idx])
 
         if path.startswith('/'):
             path = path[1:]
 
-        output_path = os.path.join(output_path, path)
+        return os.path.join(output_path, path)
+
+
+    def is_demuxed(self, output_filename):
+        return self.demux and os.path.splitext(output_filename)[1].lower() == ".pss"
 
-        if not os.path.exists(os.path.dirname(output_path)):
-            os.makedirs(os.path.dirname(output_path))
 
-        open(output_path, "wb").write(data)
+    def get_record_filename(self, output_filename):
+        # Without the raw .pss the demuxed video stands in for it
+        if self.is_demuxed(output_filename) and not self.keep_pss:
+            return os.path.splitext(output_filename)[0] + ".m2v"
 
-        if self.demux and os.path.splitext(output_path)[1].lower() == ".pss":
+        return output_filename
+
+
+    def write_entry(self, output_filename, data, entry=None, manifest=None, check=None):
+        # data is None when the payload is already in the blob store. check is
+        # the MD5 of data from extract_data_mem_many, if it was hashed there
+        size = len(data) if data is not None else entry['filesize']
+        keep_raw = self.keep_pss or not self.is_demuxed(output_filename)
+
+        # Payloads go in the store even when only their demuxed streams are
+        # kept, so later dumps don't have to read and decrypt them again
+        if keep_raw or self.store is not None:
+            with self.metrics.phase("write", size, 1):
+                if isinstance(check, Future):
+                    check = check.result().digest()
+
+                stored = data is None or (self.store is not None and entry is not None and self.store.put(entry['md5sum'], data, check))
+
+                if keep_raw and stored:
+                    self.store.link(entry['md5sum'], output_filename)
+
+                elif keep_raw:
+                    self.write_file(output_filename, data)
+
+        if self.is_demuxed(output_filename):
+            if data is None:
+                data = self.store.read(entry['md5sum'])
+
+            # Demux straight from memory instead of reading the .pss back
             from pss_demux import demux_pss
-            demux_pss(output_path, os.path.dirname(output_path))
 
-        return True
+            with self.metrics.phase("demux", size, 1), self.profiler.phase("demux"):
+                demux_pss(output_filename, os.path.dirname(output_filename), data)
+
+        if manifest is not None:
+            manifest.add(entry, self.get_record_filename(output_filename))
+
+
+    def extract_all(self, output_path, manifest=None):
+        with self.metrics.phase("extract", int(np.sum(self.entries['filesize'], dtype=np.int64)), len(self.entries)), self.profiler.phase("extract_all"):
+            if self.jobs > 1:
+                named, skipped = self.extract_packs_parallel(output_path, manifest)
+
+            else:
+                named, skipped = self.extract_packs(self.extract_batches(), output_path, manifest)
+
+        if skipped:
+            print("Skipped %d files already extracted" % skipped)
+
+        return named
+
+
+    def extract_packs_parallel(self, output_path, manifest=None):
+        # Every worker process takes whole packs and does the reading,
+        # decryption, verification and writing for them, sending back only
+        # counts and checksum mismatches
+        packids = self.entries['packid'][self.extract_order]
+        packs = np.split(self.extract_order, np.flatnonzero(np.diff(packids)) + 1)
+
+        # Biggest packs first so the last ones to finish are short
+        packs.sort(key=lambda order: -int(self.entries['filesize'][order].sum()))
+
+        named = 0
+        skipped = 0
+
+        with ProcessPoolExecutor(self.jobs, initializer=init_extract_worker, initargs=(self, manifest, output_path)) as executor:
+            futures = {executor.submit(extract_pack_worker, order): order for order in packs if len(order)}
+
+            for future in as_completed(futures):
+                result = future.result()
+                named += result['named']
+                skipped += result['skipped']
+                self.verifier.mismatches += result['mismatches']
+                self.metrics.merge(result['metrics'])
+                self.metrics.advance(len(futures[future]), int(self.entries['filesize'][futures[future]].sum()))
+
+        return named, skipped
+
+
+    def extract_packs(self, batches, output_path, manifest=None):
+        # Walks the packs sequentially one batch at a time while a pool of
+        # threads writes out the entries of the batches already read
+        named = 0
+        skipped = 0
+        reader = PackReader()
+        pending = [([], 0) for _ in range(EXTRACT_BUFFERS)]
+
+        with ThreadPoolExecutor(EXTRACT_WORKERS) as pool:
+            for batch, idxs in enumerate(batches):
+                slot = batch % EXTRACT_BUFFERS
+
+                # Everything still using this buffer has to finish first
+                futures, checks = pending[slot]
+
+                for future in futures:
+                    future.result()
+
+                self.verifier.wait(checks)
+
+                futures = []
+                todo = []
+                stored = []
+
+                for idx in idxs:
+                    if self.names[idx] is not None:
+                        named += 1
+
+                    if manifest is not None and manifest.is_done(self.get_entry(idx), self.get_record_filename(self.get_output_filename(output_path, idx))):
+                        skipped += 1
+
+                    elif self.store is not None and self.store.has(bytes(self.entries['md5sum'][idx])):
+                        # Known payloads are linked without reading the pack
+                        stored.append(idx)
+
+                    else:
+                        todo.append(idx)
+
+                checks = [None] * len(todo)
+                extracted = [(idx, None, True, None) for idx in stored] + list(zip(todo, self.extract_data_mem_many(todo, reader, slot, checks), [False] * len(todo), checks))
+
+                for idx, data, from_store, check in extracted:
+                    entry = self.get_entry(idx)
+                    output_filename = self.get_output_filename(output_path, idx)
+
+                    if 'orig_filename' in entry:
+                        print("%-64s packid[%04d] offset[%08x] filesize[%08x] hash[%08x]" % (entry['orig_filename'], entry['packid'], entry['offset'], entry['filesize'], entry['key1']))
+
+                    else:
+                        print("Dumping", output_filename)
+
+                    if data is not None or from_store:
+                        if self.profiler.mode is not None:
+                            # Profiled phases such as demux have to run on
+                            # this thread
+                            self.write_entry(output_filename, data, entry, manifest, check)
+
+                        else:
+                            futures.append(pool.submit(self.write_entry, output_filename, data, entry, manifest, check))
+
+                pending[slot] = (futures, self.verifier.submitted)
+                self.metrics.advance(len(idxs), int(self.entries['filesize'][idxs].sum()))
+
+            for futures, _ in pending:
+                for future in futures:
+                    future.result()
+
+        reader.close()
+
+        return named, skipped
+
+
+    def write_file(self, output_filename, data):
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+
+        with open(output_filename, "wb") as outfile:
+            outfile.write(data)
+
+
+# State of an extraction worker process
+worker_dumper = None
+worker_args = None
+
+
+def init_extract_worker(dumper, manifest, output_path):
+    global worker_dumper, worker_args
+
+    # Forked workers get the parent's objects as they are, along with its
+    # thread pools (without their threads), pending checks and metrics.
+    # Going through the pickling hooks gives every worker fresh ones, the
+    # same as when the arguments really are pickled
+    dumper.__setstate__(dumper.__getstate__())
+
+    if manifest is not None:
+        manifest.__setstate__(manifest.__getstate__())
+
+    # Worker processes share the cores between their decryption threads
+    pakbackend.DECRYPT_WORKERS = max(1, pakbackend.DECRYPT_WORKERS // dumper.jobs)
+
+    worker_dumper = dumper
+    worker_args = (output_path, manifest)
+
+
+def extract_pack_worker(order):
+    named, skipped = worker_dumper.extract_packs(worker_dumper.extract_batches(order), *worker_args)
+
+    return {
+        'named': named,
+        'skipped': skipped,
+        'mismatches': worker_dumper.verifier.report(),
+        'metrics': worker_dumper.metrics.collect(),
+    }
+
+
+# Rules deriving more candidates from the filenames already found. The first
+# rule whose marker is in a filename applies and every (old, new) replacement
+# of it gives one candidate
+DERIVATION_RULES = [
+    ("gf_", [("gf_", "dm_")]),
+    ("dm_", [("dm_", "gf_")]),
+    ("_gf", [("_gf", "_dm")]),
+    ("_dm", [("_dm", "_gf")]),
+    ("tex_", [("tex_", "mdl_"), ("d3/model/tex_", "aep/")]),
+    ("mdl_", [("mdl_", "tex_"), ("d3/model/mdl_", "aep/")]),
+]
+
+
+def expand_rows(template, rows):
+    # ("same", values) gives every field of the template the same value,
+    # ("product", [values, ...]) gives every combination of per-field values
+    kind, values = rows
+
+    if kind == "same":
+        return zip(*[values] * template.count("%"))
+
+    return itertools.product(*values)
+
+
+def expand_templates(template_specs):
+    for templates, rows in template_specs:
+        for template in templates:
+            yield template, expand_rows(template, rows)
+
+
+def derive_filenames(filename, rules=DERIVATION_RULES):
+    for marker, replacements in rules:
+        if marker in filename:
+            for old, new in replacements:
+                yield filename.replace(old, new)
+
+            return
 
 
 def bruteforce_filenames(dumper):
-    filenames = []
+    filenames = set()
 
-    # TODO: Remove duplicates
     possible_filenames = [
         "/data/product/music/system/gfv_se.va2",
         "/data/product/music/system/gfv_se.va3",
@@ -816,20 +2086,17 @@ def bruteforce_filenames(dumper):
         "v8_entry",
     ]
 
-    for system_audio_part in system_audio_parts:
-        for ext in ['bin', 'va2', 'va3', 'pss']:
-            for game in ['_gf', '_dm', '']:
-                path = "/data/product/music/system/%s%s.%s" % (system_audio_part, game, ext)
-                possible_filenames.append(path)
+    template_specs = [
+        (["/data/product/music/system/%s%s.%s"], ("product", [system_audio_parts, ['_gf', '_dm', ''], ['bin', 'va2', 'va3', 'pss']])),
+    ]
 
-    for path in possible_filenames:
-        if dumper.file_exists(path):
-            filenames.append(path)
+    # The literal list has repeats, only probe each name once
+    possible_filenames = list(dict.fromkeys(possible_filenames))
 
-    filenames = list(set(filenames))
+    filenames.update(itertools.compress(possible_filenames, dumper.file_exists_many(possible_filenames)))
 
     if "/data/product/d3/package/packlist.bin" in filenames:
-        data = dumper.extract_data_mem("/data/product/d3/package/packlist.bin")
+        data = bytes(dumper.extract_data_mem("/data/product/d3/package/packlist.bin"))
 
         if data[:4] == b"TSLF":
             offset = int.from_bytes(data[0x14:0x18], 'little')
@@ -841,33 +2108,24 @@ def bruteforce_filenames(dumper):
 
         offsets = [x for x in [int.from_bytes(data[offset+idx:offset+idx+4], 'little') for idx in range(0, first_offset - offset, 4)] if x != 0]
 
+        paths = []
         for offset in offsets:
             string = data[offset:offset+data[offset:].index(b'\0')].decode('ascii').strip('\0')
-            path = "/data/product/d3/package/%s" % (string)
+            paths.append("/data/product/d3/package/%s" % (string))
 
-            if dumper.file_exists(path):
-                filenames.append(path)
+        filenames.update(itertools.compress(paths, dumper.file_exists_many(paths)))
 
     if "/data/product/aep/gf_aep_list.bin" in filenames:
-        data = dumper.extract_data_mem("/data/product/aep/gf_aep_list.bin")
+        data = bytes(dumper.extract_data_mem("/data/product/aep/gf_aep_list.bin"))
 
+        paths = []
         for offset in range(0, len(data), 0x20):
             string = data[offset:offset+data[offset:].index(b'\0')].decode('ascii').strip('\0')
-            path = "/data/product/aep/%s.bin" % (string)
-
-            if dumper.file_exists(path):
-                filenames.append(path)
-
-            path = "/data/product/d3/model/mdl_%s.bin" % (string)
-
-            if dumper.file_exists(path):
-                filenames.append(path)
-
-            path = "/data/product/d3/model/tex_%s.bin" % (string)
-
-            if dumper.file_exists(path):
-                filenames.append(path)
+            paths.append("/data/product/aep/%s.bin" % (string))
+            paths.append("/data/product/d3/model/mdl_%s.bin" % (string))
+            paths.append("/data/product/d3/model/tex_%s.bin" % (string))
 
+        filenames.update(itertools.compress(paths, dumper.file_exists_many(paths)))
 
     templates = [
         "/data/product/music/m%04d/event%04d.evt",
@@ -925,17 +2183,8 @@ def bruteforce_filenames(dumper):
             templates.append("/data/product/music/m%04d/bgm%04d" + t + "." + ext)
             templates.append("/data/product/music/m%04d/b%04d" + t + "." + ext)
 
-    for i in range(0, 9999):
-        for template in templates:
-            path = template % tuple(i for _ in range(template.count("%04d")))
-
-            if dumper.file_exists(path):
-                filenames.append(path)
-
-        for j in range(0, 10):
-            for path in ["/data/product/music/m%04d/dm_lesson%01d.va2" % (i, j), "/data/product/music/m%04d/gt_lesson%01d.va2" % (i, j)]:
-                if dumper.file_exists(path):
-                    filenames.append(path)
+    template_specs.append((templates, ("same", range(0, 9999))))
+    template_specs.append((["/data/product/music/m%04d/dm_lesson%01d.va2", "/data/product/music/m%04d/gt_lesson%01d.va2"], ("product", [range(0, 9999), range(0, 10)])))
 
     templates = [
         "/data/product/aep/gf_int_%03d.bin",
@@ -945,12 +2194,7 @@ def bruteforce_filenames(dumper):
         "/data/product/aep/gf_int_%03d.bin",
     ]
 
-    for i in range(0, 1000):
-        for template in templates:
-            path = template % tuple(i for _ in range(template.count("%03d")))
-
-            if dumper.file_exists(path):
-                filenames.append(path)
+    template_specs.append((templates, ("same", range(0, 1000))))
 
     templates = [
         "/data/product/d3/model/mdl_gf_idx_image_%02d.bin",
@@ -999,12 +2243,7 @@ def bruteforce_filenames(dumper):
         "/data/product/aep/sp_ggm_eflane%02d.bin",
     ]
 
-    for i in range(0, 100):
-        for template in templates:
-            path = template % tuple(i for _ in range(template.count("%02d")))
-
-            if dumper.file_exists(path):
-                filenames.append(path)
+    template_specs.append((templates, ("same", range(0, 100))))
 
     templates = [
         "/data/product/d3/model/mdl_gf_game%01d.bin",
@@ -1016,97 +2255,51 @@ def bruteforce_filenames(dumper):
         "/data/product/d3/model/tex_gf_battle_common%01d.bin",
     ]
 
-    for i in range(0, 10):
-        for template in templates:
-            path = template % tuple(i for _ in range(template.count("%01d")))
-
-            if dumper.file_exists(path):
-                filenames.append(path)
-
-    for i in range(0, 100):
-        for j in range(0, 100):
-            for ext in ['va2', 'va3']:
-                paths = [
-                    "/data/product/music/system/gfv%d_v%02d.%s" % (i, j, ext),
-                    "/data/product/music/system/gf%d_v%02d.%s" % (i, j, ext),
-                    "/data/product/music/system/gfxg%d_v%02d.%s" % (i, j, ext),
-                    "/data/product/music/system/dmv%d_v%02d.%s" % (i, j, ext),
-                    "/data/product/music/system/dm%d_v%02d.%s" % (i, j, ext),
-                    "/data/product/music/system/dmxg%d_v%02d.%s" % (i, j, ext),
-                ]
+    template_specs.append((templates, ("same", range(0, 10))))
 
-                for path in paths:
-                    if dumper.file_exists(path):
-                        filenames.append(path)
-
-        for ext in ['va2', 'va3']:
-            paths = [
-                "/data/product/music/system/gfv%d_se.%s" % (i, ext),
-                "/data/product/music/system/gfv_v%02d.%s" % (i, ext),
-                "/data/product/music/system/gf%d_se.%s" % (i, ext),
-                "/data/product/music/system/gf_v%02d.%s" % (i, ext),
-                "/data/product/music/system/gfxg%d_se.%s" % (i, ext),
-                "/data/product/music/system/gfxg_v%02d.%s" % (i, ext),
-                "/data/product/music/system/dmv%d_se.%s" % (i, ext),
-                "/data/product/music/system/dmv_v%02d.%s" % (i, ext),
-                "/data/product/music/system/dm%d_se.%s" % (i, ext),
-                "/data/product/music/system/dm_v%02d.%s" % (i, ext),
-                "/data/product/music/system/dmxg%d_se.%s" % (i, ext),
-                "/data/product/music/system/dmxg_v%02d.%s" % (i, ext),
-            ]
-
-            for path in paths:
-                if dumper.file_exists(path):
-                    filenames.append(path)
-
-    for filename in filenames:
-        if "gf_" in filename:
-            new_filename = filename.replace("gf_", "dm_")
-
-            if new_filename not in filenames and dumper.file_exists(new_filename):
-                filenames.append(new_filename)
-
-        elif "dm_" in filename:
-            new_filename = filename.replace("dm_", "gf_")
-
-            if new_filename not in filenames and dumper.file_exists(new_filename):
-                filenames.append(new_filename)
-
-        elif "_gf" in filename:
-            new_filename = filename.replace("_gf", "_dm")
-
-            if new_filename not in filenames and dumper.file_exists(new_filename):
-                filenames.append(new_filename)
-
-        elif "_dm" in filename:
-            new_filename = filename.replace("_dm", "_gf")
-
-            if new_filename not in filenames and dumper.file_exists(new_filename):
-                filenames.append(new_filename)
-
-        elif "tex_" in filename:
-            new_filename = filename.replace("tex_", "mdl_")
+    templates = [
+        "/data/product/music/system/gfv%d_v%02d.%s",
+        "/data/product/music/system/gf%d_v%02d.%s",
+        "/data/product/music/system/gfxg%d_v%02d.%s",
+        "/data/product/music/system/dmv%d_v%02d.%s",
+        "/data/product/music/system/dm%d_v%02d.%s",
+        "/data/product/music/system/dmxg%d_v%02d.%s",
+    ]
 
-            if new_filename not in filenames and dumper.file_exists(new_filename):
-                filenames.append(new_filename)
+    template_specs.append((templates, ("product", [range(0, 100), range(0, 100), ['va2', 'va3']])))
 
-            new_filename = filename.replace("d3/model/tex_", "aep/")
+    templates = [
+        "/data/product/music/system/gfv%d_se.%s",
+        "/data/product/music/system/gfv_v%02d.%s",
+        "/data/product/music/system/gf%d_se.%s",
+        "/data/product/music/system/gf_v%02d.%s",
+        "/data/product/music/system/gfxg%d_se.%s",
+        "/data/product/music/system/gfxg_v%02d.%s",
+        "/data/product/music/system/dmv%d_se.%s",
+        "/data/product/music/system/dmv_v%02d.%s",
+        "/data/product/music/system/dm%d_se.%s",
+        "/data/product/music/system/dm_v%02d.%s",
+        "/data/product/music/system/dmxg%d_se.%s",
+        "/data/product/music/system/dmxg_v%02d.%s",
+    ]
 
-            if new_filename not in filenames and dumper.file_exists(new_filename):
-                filenames.append(new_filename)
+    template_specs.append((templates, ("product", [range(0, 100), ['va2', 'va3']])))
 
-        elif "mdl_" in filename:
-            new_filename = filename.replace("mdl_", "tex_")
+    filenames.update(dumper.templates_exist_many(expand_templates(template_specs)))
 
-            if new_filename not in filenames and dumper.file_exists(new_filename):
-                filenames.append(new_filename)
+    # Follow the derivation rules from every new hit until nothing new turns
+    # up, never probing the same candidate twice
+    tried = set(filenames)
+    found = filenames
 
-            new_filename = filename.replace("d3/model/mdl_", "aep/")
+    while found:
+        candidates = sorted(set(itertools.chain.from_iterable(derive_filenames(filename) for filename in found)) - tried)
+        tried.update(candidates)
 
-            if new_filename not in filenames and dumper.file_exists(new_filename):
-                filenames.append(new_filename)
+        found = set(itertools.compress(candidates, dumper.file_exists_many(candidates)))
+        filenames |= found
 
-    return filenames
+    return sorted(filenames)
 
 
 def find_packinfo(path):
@@ -1125,7 +2318,26 @@ if __name__ == "__main__":
     parser.add_argument('-i', '--input', help='Input folder', required=True)
     parser.add_argument('-o', '--output', help='Output folder (optional)', default="output")
     parser.add_argument('-d', '--demux', help='Demux PSS files', default=False, action="store_true")
-    parser.add_argument('-f', '--fast', help='Use Cython decryption code', default=False, action="store_true")
+    parser.add_argument('--no-raw-pss', help='Only keep the demuxed streams of PSS files (requires --demux)', default=False, action="store_true")
+    parser.add_argument('-f', '--fast', help='Use Cython decryption code (same as --decrypt-backend compiled)', default=False, action="store_true")
+    parser.add_argument('--decrypt-backend', help='Decryption implementation to use', default="auto", choices=["auto"] + [name for name, _ in pakbackend.DECRYPT_BACKENDS])
+    parser.add_argument('--hash-backend', help='Filename hashing implementation to use', default="auto", choices=["auto"] + [name for name, _ in pakbackend.HASH_BACKENDS])
+    parser.add_argument('--calibrate', help='Time the available backends on a small sample and pick the fastest', default=False, action="store_true")
+    parser.add_argument('--no-cache', help='Ignore the cached filenames and bruteforce them again', default=False, action="store_true")
+    parser.add_argument('-j', '--jobs', help='Number of worker processes to use', default=1, type=int)
+    parser.add_argument('--solve-prefix', help='Recover unknown filenames under this path prefix (can be repeated)', default=[], action="append")
+    parser.add_argument('--solve-ext', help='Extension for recovered filenames (can be repeated)', default=[], action="append")
+    parser.add_argument('--solve-charset', help='Characters allowed in recovered filenames', default="abcdefghijklmnopqrstuvwxyz0123456789_")
+    parser.add_argument('--solve-max-length', help='Longest name part to solve for', default=6, type=int)
+    parser.add_argument('--no-resume', help='Extract every file again instead of skipping the ones a previous run finished', default=False, action="store_true")
+    parser.add_argument('--catalog', help='Write the index with resolved filenames to this SQLite file instead of extracting', default=None)
+    parser.add_argument('--store', help='Keep file contents once in this folder keyed by MD5 and hardlink them into the output folder', default=None)
+    parser.add_argument('--verify', help='Check the MD5 of every extracted file, a sample of them or none', default="full", choices=["none", "sample", "full"])
+    parser.add_argument('--progress', help='Print extraction progress every this many seconds', default=None, type=float)
+    parser.add_argument('--profile', help='Profile CPU time or memory use of every phase', default=None, choices=["cpu", "mem"])
+    parser.add_argument('--profile-dir', help='Folder for the profile of every phase (default: profile in the output folder)', default=None)
+    parser.add_argument('--profile-top', help='Number of entries in the summary of every profiled phase', default=PROFILE_TOP, type=int)
+    parser.add_argument('--metrics', help='Write per-phase timings and throughput as JSON to this file (default: metrics.json in the output folder)', default=None)
 
     args = parser.parse_args()
 
@@ -1135,32 +2347,69 @@ if __name__ == "__main__":
         print("Couldn't find packinfo.bin in input directory")
         exit(1)
 
-    dumper = PakDumper(packinfo_path, args.demux, args.fast)
+    if args.profile and args.jobs > 1:
+        print("Only the main process is profiled, use -j 1 to profile extraction")
 
-    filenames = bruteforce_filenames(dumper)
+    profiler = Profiler(args.profile, args.profile_dir or os.path.join(args.output, "profile"), args.profile_top)
 
-    sorted_keys = sorted(dumper.entries, key=lambda x:(dumper.entries[x].get('packid', 0), dumper.entries[x].get('offset', 0)))
+    dumper = PakDumper(packinfo_path, args.input, args.demux, "compiled" if args.fast else args.decrypt_backend, args.jobs, args.verify, not args.no_raw_pss, BlobStore(args.store) if args.store else None, args.hash_backend, args.calibrate, profiler)
+    print("Using %s decryption and %s filename hashing" % (dumper.decrypt_backend, dumper.hash_backend))
+    dumper.metrics.progress = args.progress
 
-    named = 0
+    cache_path = os.path.join(args.output, "names_cache.json")
+    filenames = None if args.no_cache else dumper.load_name_cache(cache_path)
 
-    for k in sorted_keys:
-        if 'orig_filename' in dumper.entries[k]:
-            print("%-64s packid[%04d] offset[%08x] filesize[%08x] hash[%08x]" % (dumper.entries[k]['orig_filename'], dumper.entries[k]['packid'], dumper.entries[k]['offset'], dumper.entries[k]['filesize'], k))
-            dumper.extract_data(dumper.entries[k]['orig_filename'], args.input, args.output)
-            named += 1
+    if filenames is not None:
+        print("Loaded %d filenames from %s" % (len(filenames), cache_path))
 
-        else:
-            # print("Dumping %08x.bin" % k)
+    else:
+        with dumper.metrics.phase("bruteforce"), profiler.phase("bruteforce_filenames"):
+            filenames = bruteforce_filenames(dumper)
+
+    for prefix in args.solve_prefix:
+        for ext in args.solve_ext or [""]:
+            for filename in dumper.solve_filenames(prefix, ext, args.solve_charset, args.solve_max_length):
+                print("Solved", filename)
+                filenames.append(filename)
+
+    dumper.save_name_cache(cache_path)
+
+    if args.catalog:
+        dumper.write_catalog(args.catalog)
+
+        print("Wrote %d entries (%d named) to %s" % (len(dumper.entries), np.count_nonzero(~dumper.unnamed()), args.catalog))
+        profiler.close()
+        exit(0)
+
+    manifest = Manifest(os.path.join(args.output, "manifest.jsonl"), not args.no_resume)
+    named = dumper.extract_all(args.output, manifest)
+    manifest.close()
+
+    mismatches = dumper.verifier.report()
+
+    for mismatch in mismatches:
+        print("Bad checksum for", mismatch['filename'] or mismatch['key1'])
+
+    if mismatches:
+        report_path = os.path.join(args.output, "verify_report.json")
+
+        with open(report_path, "w") as outfile:
+            json.dump(mismatches, outfile, indent=4)
+
+        print("Wrote %d checksum mismatches to %s" % (len(mismatches), report_path))
+
+    dumper.verifier.close()
+    dumper.pack_pool.close()
+
+    metrics_path = args.metrics or os.path.join(args.output, "metrics.json")
 
-            data = dumper.extract_data_mem(None, args.input, k)
+    with open(metrics_path, "w") as outfile:
+        json.dump(dumper.metrics.report(), outfile, indent=4)
 
-            output_path = os.path.join(args.output, "unknown")
-            os.makedirs(output_path, exist_ok=True)
+    print("Wrote metrics to %s" % metrics_path)
 
-            output_filename = os.path.join(output_path, "%08x.bin" % k)
-            print("Dumping", output_filename)
-            open(output_filename, "wb").write(data)
+    profiler.close()
 
     print("Named: %d" % (named))
-    print("Unnamed: %d" % (len(sorted_keys) - named))
-    print("Total: %d" % (len(sorted_keys)))
\ No newline at end of file
+    print("Unnamed: %d" % (len(dumper.entries) - named))
+    print("Total: %d" % (len(dumper.entries)))
\ No newline at end of file
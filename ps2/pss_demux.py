@@ -2,15 +2,19 @@ import argparse
 import os
 import sys
 
-def demux_pss(input_filename, output_folder):
+def demux_pss(input_filename, output_folder, data=None):
+    # data can be any buffer holding the PSS (e.g. straight out of the pak
+    # dumper), input_filename then only names the outputs
     base_filename = os.path.splitext(os.path.basename(input_filename))[0]
 
     if output_folder and not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+        os.makedirs(output_folder, exist_ok=True)
 
-    with open(input_filename, "rb") as infile:
-        data = bytearray(infile.read())
+    if data is None:
+        with open(input_filename, "rb") as infile:
+            data = infile.read()
 
+    with memoryview(data) as data:
         idx = 0
 
         video_output = open(os.path.join(output_folder, "%s.m2v" % base_filename), "wb")